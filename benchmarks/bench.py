@@ -0,0 +1,472 @@
+#!/usr/bin/env python
+#
+# Benchmarks for ribs and the game.
+#
+#   python benchmarks/bench.py run -o results.json
+#   python benchmarks/bench.py compare old.json new.json
+#
+# Everything runs with SDL's dummy drivers, so no window is opened and
+# this works on a build server. Timings are in seconds per call.
+#
+
+import os
+import sys
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# The game loads its resources relative to the repository.
+os.chdir(ROOT)
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import time
+
+import pygame as pg
+import ribs
+import game
+
+
+BENCHMARKS = []
+def benchmark(name):
+    """Registers a function returning a list of per call timings."""
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+def measure(func, samples=200, number=100):
+    """Times func, number calls per sample, and returns seconds per call."""
+    # Warm up caches before measuring.
+    for _ in range(number):
+        func()
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number)
+    return timings
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(timings):
+    ordered = sorted(timings)
+    return {
+        "mean": statistics.mean(ordered),
+        "stdev": statistics.pstdev(ordered),
+        "min": ordered[0],
+        "max": ordered[-1],
+        "p50": percentile(ordered, 0.50),
+        "p90": percentile(ordered, 0.90),
+        "p95": percentile(ordered, 0.95),
+        "p99": percentile(ordered, 0.99),
+        "samples": len(ordered),
+    }
+
+
+def open_window(size=(1080, 720)):
+    """Makes sure there is something to draw on."""
+    ribs.HEADLESS = False
+    pg.init()
+    if pg.display.get_surface() is None or pg.display.get_surface().get_size() != size:
+        pg.display.set_mode(size)
+
+
+class Body:
+    """The smallest thing the collision functions accept."""
+
+    def __init__(self, centerx, centery, width, height):
+        self.centerx = centerx
+        self.centery = centery
+        self.width = width
+        self.height = height
+
+
+#
+# Synthetic levels
+#
+
+def stress_level(width, height, walls, enemies, seed=1):
+    """A level string with about walls wall tiles and enemies enemies."""
+    rng = random.Random(seed)
+    rows = [[" "] * width for _ in range(height)]
+    for x in range(width):
+        rows[0][x] = rows[-1][x] = "#"
+    for y in range(height):
+        rows[y][0] = rows[y][-1] = "#"
+
+    # Platforms with gaps, every other row so there is room to walk on them.
+    placed = 2 * width + 2 * height - 4
+    for y in range(2, height - 1, 2):
+        x = rng.randint(1, 4)
+        while x < width - 1 and placed < walls:
+            for _ in range(rng.randint(3, 12)):
+                if x < width - 1:
+                    rows[y][x] = "#"
+                    placed += 1
+                    x += 1
+            x += rng.randint(1, 3)
+
+    free = [(x, y) for y in range(1, height - 1) for x in range(1, width - 1)
+            if rows[y][x] == " " and rows[y + 1][x] == "#"]
+    rng.shuffle(free)
+    start_x, start_y = free.pop()
+    rows[start_y][start_x] = "S"
+    for x, y in free[:enemies]:
+        rows[y][x] = rng.choice("XY")
+    return "\n" + "\n".join("".join(row) for row in rows) + "\n"
+
+
+STRESS_LEVELS = {
+    "walls_5k": stress_level(140, 90, 5000, 10),
+    "enemies_1k": stress_level(100, 80, 2000, 1000),
+}
+
+
+#
+# ribs primitives
+#
+
+@benchmark("overlap_data")
+def bench_overlap_data():
+    a = pg.Rect(200, 200, 100, 100)
+    b = pg.Rect(250, 250, 50, 100)
+    return measure(lambda: ribs.overlap_data(a, b), number=1000)
+
+
+@benchmark("overlap_into")
+def bench_overlap_into():
+    a = pg.Rect(200, 200, 100, 100)
+    b = pg.Rect(250, 250, 50, 100)
+    normal = ribs.Vec2()
+    return measure(lambda: ribs.overlap_into(a, b, normal), number=1000)
+
+
+@benchmark("solve_rect_overlap")
+def bench_solve_rect_overlap():
+    a = Body(0, 0, 40, 40)
+    wall = Body(0, 30, 40, 40)
+
+    def solve():
+        a.centerx = 5
+        a.centery = 0
+        ribs.solve_rect_overlap(a, wall, (10, 200), mass_b=0, bounce=0.1)
+    return measure(solve, number=1000)
+
+
+@benchmark("solve_overlap_into")
+def bench_solve_overlap_into():
+    a = Body(0, 0, 40, 40)
+    wall = Body(0, 30, 40, 40)
+    velocity = ribs.Vec2()
+
+    def solve():
+        a.centerx = 5
+        a.centery = 0
+        velocity.set(10, 200)
+        ribs.solve_overlap_into(a, wall, velocity, mass_b=0, bounce=0.1)
+    return measure(solve, number=1000)
+
+
+@benchmark("solve_rect_overlap_batch[100x100]")
+def bench_solve_rect_overlap_batch():
+    if ribs.np is None:
+        return None
+    rng = random.Random(2)
+    movers = ribs.np.array([(rng.uniform(0, 400), rng.uniform(0, 400), 40, 40)
+                            for _ in range(100)])
+    vels = ribs.np.zeros((100, 2))
+    statics = ribs.np.array([(x * 40 + 20, 420, 40, 40) for x in range(100)])
+    return measure(lambda: ribs.solve_rect_overlap_batch(movers, vels, statics),
+                   samples=50, number=5)
+
+
+@benchmark("sweep_and_prune[3000]")
+def bench_sweep_and_prune():
+    if ribs.np is None:
+        return None
+    rng = random.Random(3)
+    rects = ribs.np.array([(rng.uniform(0, 4000), rng.uniform(0, 3000), 40, 40)
+                           for _ in range(3000)])
+    steps = ribs.np.array([(rng.uniform(-2, 2), rng.uniform(-2, 2)) for _ in range(3000)])
+    broadphase = ribs.SweepAndPrune()
+
+    def sweep():
+        # Move a little every call, like a frame would.
+        rects[:, :2] += steps
+        broadphase.pairs(rects)
+    return measure(sweep, samples=50, number=5)
+
+
+@benchmark("draw_transformed[scaled]")
+def bench_draw_transformed():
+    open_window()
+    img = pg.image.load("res/myra.png")
+    return measure(lambda: ribs.draw_transformed(img, (100, 100), (0.1, 0.1)))
+
+
+@benchmark("draw_transformed[rotated]")
+def bench_draw_transformed_rotated():
+    open_window()
+    img = pg.image.load("res/myra.png")
+    return measure(lambda: ribs.draw_transformed(img, (100, 100), (0.1, 0.1), 30,
+                                                 flip=(True, False)))
+
+
+@benchmark("draw_transformed[loaded]")
+def bench_draw_transformed_loaded():
+    open_window()
+    img = ribs.load_image("res/myra.png", 0.1)
+    return measure(lambda: ribs.draw_transformed(img, (100, 100), (0.1, 0.1)))
+
+
+@benchmark("draw_text")
+def bench_draw_text():
+    open_window()
+    return measure(lambda: ribs.draw_text("Level: 1", (0, 0)))
+
+
+@benchmark("draw_sprites[1000]")
+def bench_draw_sprites():
+    open_window()
+    img = pg.image.load("res/myra.png")
+    rng = random.Random(1)
+    sprites = [((rng.uniform(0, 1080), rng.uniform(0, 720)), (rng.random() < 0.5, False))
+               for _ in range(1000)]
+
+    def draw_all():
+        for position, flip in sprites:
+            ribs.draw_transformed(img, position, (0.1, 0.1), flip=flip)
+        ribs.draw_sprite_batch()
+
+    results = {"draw_sprites[1000, immediate]": measure(draw_all, samples=50, number=5)}
+    for flip in ((False, False), (True, False)):
+        ribs.add_to_atlas(img, (0.1, 0.1), flip=flip)
+    ribs.pack_atlas()
+    ribs.set_batch_drawing(True)
+    try:
+        results["draw_sprites[1000, batch]"] = measure(draw_all, samples=50, number=5)
+    finally:
+        ribs.set_batch_drawing(False)
+    return results
+
+
+@benchmark("play_sound")
+def bench_play_sound():
+    open_window()
+    if pg.mixer.get_init() is None:
+        return None
+    sound = ribs.load_sound("res/plong.wav")
+    timings = measure(lambda: ribs.play_sound(sound), samples=50, number=10)
+    # The channels play_sound reserves mustn't be all the mixer has.
+    channel = sound.play()
+    if channel is None:
+        raise RuntimeError("Sound.play found no free channel after play_sound")
+    pg.mixer.stop()
+    return timings
+
+
+@benchmark("parse_level")
+def bench_parse_level():
+    results = {}
+    for index, level_string in enumerate(game.levels):
+        results[f"parse_level[level{index + 1}]"] = \
+            measure(lambda: game.parse_level(level_string), samples=50, number=10)
+    for name, level_string in STRESS_LEVELS.items():
+        results[f"parse_level[{name}]"] = \
+            measure(lambda: game.parse_level(level_string), samples=10, number=1)
+    return results
+
+
+@benchmark("load_level")
+def bench_load_level():
+    # Loading an already compiled level, what happens on every restart.
+    results = {}
+    for index in range(len(game.levels)):
+        results[f"load_level[level{index + 1}]"] = \
+            measure(lambda: game.load_level(index), samples=50, number=10)
+    return results
+
+
+@benchmark("snapshot")
+def bench_snapshot():
+    results = {}
+    levels = {"level6": game.levels[5], "enemies_1k": STRESS_LEVELS["enemies_1k"]}
+    for name, level_string in levels.items():
+        level = game.parse_level(level_string)
+        player = game.Player()
+        player.centerx, player.centery = level.start
+        all_barrs = list(level.barrs)
+        snapshots = game.level_snapshots(game.snapshot_layout(all_barrs), level.enemies.state_size())
+
+        def snapshot():
+            game.snapshot_state(snapshots, player, level.enemies, level.barrs, all_barrs)
+
+        def restore():
+            game.restore_state(snapshots.get(), snapshots.buffer, snapshots.extra_offset(),
+                               player, level.enemies, level.barrs, all_barrs)
+
+        number = 100 if len(level.enemies) < 100 else 10
+        results[f"snapshot[{name}]"] = measure(snapshot, samples=50, number=number)
+        results[f"restore[{name}]"] = measure(restore, samples=50, number=number)
+    game.current_level = 0
+    return results
+
+
+#
+# Whole frames of the game
+#
+
+def walk_and_jump(frame):
+    """Scripted input: run right and left, jumping now and then."""
+    keys = ["d"] if (frame // 120) % 2 == 0 else ["a"]
+    if frame % 50 < 3:
+        keys.append(" ")
+    return keys
+
+
+def time_frames(level_strings, frames):
+    """Runs the game headless on the given levels, timing every frame."""
+    timings = []
+
+    def timed_update():
+        iterator = game.update()
+        while True:
+            start = time.perf_counter()
+            try:
+                next(iterator)
+            except StopIteration:
+                return
+            timings.append(time.perf_counter() - start)
+            yield
+
+    saved_levels = game.levels
+    game.levels = level_strings
+    game.current_level = 0
+    game.level_backgrounds.clear()
+    try:
+        script = [walk_and_jump(frame) for frame in range(frames)]
+        ribs.start_game(game.init, timed_update, headless=True,
+                        input_source=ribs.ScriptedInput(script))
+    finally:
+        game.levels = saved_levels
+        game.current_level = 0
+        game.level_backgrounds.clear()
+        ribs.set_input_source(None)
+        ribs.set_batch_drawing(False)
+        ribs.set_dirty_rects(False)
+        ribs.HEADLESS = False
+    # The first frame parses the level, that's measured elsewhere.
+    return timings[1:]
+
+
+@benchmark("frame")
+def bench_frames():
+    results = {}
+    for index, level_string in enumerate(game.levels):
+        results[f"frame[level{index + 1}]"] = time_frames([level_string], 600)
+    for name, level_string in STRESS_LEVELS.items():
+        results[f"frame[{name}]"] = time_frames([level_string], 60)
+    return results
+
+
+#
+# Running and comparing
+#
+
+def run(selected):
+    results = {}
+    for name, func in BENCHMARKS:
+        if selected and not any(word in name for word in selected):
+            continue
+        print(f"{name}...", file=sys.stderr)
+        timings = func()
+        if timings is None:
+            continue
+        if isinstance(timings, dict):
+            for sub_name, sub_timings in timings.items():
+                results[sub_name] = summarize(sub_timings)
+        else:
+            results[name] = summarize(timings)
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "pygame": pg.version.ver,
+            "numpy": ribs.np.__version__ if ribs.np is not None else None,
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(old, new, threshold, stat):
+    """Prints the change of every benchmark, returns the regressed names."""
+    regressions = []
+    print(f"{'benchmark':40} {'old':>12} {'new':>12} {'change':>8}")
+    for name in sorted(set(old["results"]) | set(new["results"])):
+        if name not in old["results"] or name not in new["results"]:
+            print(f"{name:40} {'only in ' + ('new' if name in new['results'] else 'old'):>34}")
+            continue
+        before = old["results"][name][stat]
+        after = new["results"][name][stat]
+        change = (after - before) / before if before else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        elif change < -threshold:
+            flag = "  faster"
+        print(f"{name:40} {before * 1e6:10.2f}us {after * 1e6:10.2f}us {change:+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for ribs and the game.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("-o", "--output", help="write JSON results here")
+    run_parser.add_argument("only", nargs="*", help="only run benchmarks with these in the name")
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.10,
+                                help="relative slowdown counted as a regression (default 0.10)")
+    compare_parser.add_argument("--stat", default="p50",
+                                choices=["mean", "min", "p50", "p90", "p95", "p99"])
+
+    args = parser.parse_args()
+    if args.command == "run":
+        results = run(args.only)
+        text = json.dumps(results, indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(text + "\n")
+        else:
+            print(text)
+    else:
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        regressions = compare(old, new, args.threshold, args.stat)
+        if regressions:
+            print(f"{len(regressions)} regression(s)")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
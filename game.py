@@ -1,11 +1,25 @@
 from ribs import *
 from dataclasses import dataclass
+import hashlib
+import math
+import mmap
+import os
+import struct
 
 # Asset dictionary for holding all your assets.
 assets = {}
 
 GRID_SIZE = 40
 
+# Join neighbouring wall tiles into bigger rects when loading a level,
+# fewer rects means less to collide against. Off by default, since the
+# player no longer catches on the seams between tiles, which changes how
+# some collisions play out.
+MERGE_WALLS = False
+
+SKY_COLOR = pg.Color(170, 180, 255)
+WALL_COLOR = pg.Color(110, 40, 0)
+
 def clamp(val, low, high):
     return min(max(val, low), high)
 
@@ -28,38 +42,50 @@ class Player:
 
     has_barr = False
 
-@dataclass
-class Enemy:
-    centerx = 0
-    centery = 0
-    width = 40
-    height = 40
+    # Where the player was before the latest step, for smooth drawing.
+    last_centerx = 0
+    last_centery = 0
+
+class Enemy(EntityView):
+    """
+        An enemy. Its position, velocity and so on are kept in the
+        EntityStore of the level, so all enemies can be moved at once.
+    """
+    __slots__ = ()
 
-    velocity = (0, 0)
     walk_speed = 90
-    face_left = False
 
 
-def player_is_on_ground(player, walls):
+def move_rect(rect, x, y, width, height):
+    """Moves rect in place, rounding the same way pg.Rect(x, y, width, height) does."""
+    rect.x = int(x)
+    rect.y = int(y)
+    rect.width = int(width)
+    rect.height = int(height)
+    return rect
+
+
+# The detectors are reused every frame, instead of making new rects.
+ground_detector = pg.Rect(0, 0, 0, 0)
+
+def player_is_on_ground(player, wall_grid):
     size = player.width * 0.9
-    ground_detector = pg.Rect(player.centerx - size / 2,
-                              player.centery + player.height / 2,
-                              size,
-                              0.1)
-    for wall in walls:
-        _, _, yes, _ = solve_rect_overlap(ground_detector,
-                                          wall,
-                                          mass_b=0)
-        if yes:
+    move_rect(ground_detector,
+              player.centerx - size / 2,
+              player.centery + player.height / 2,
+              size,
+              0.1)
+    for wall in wall_grid.query(ground_detector):
+        if overlap_into(ground_detector, wall) >= 0:
             return True
     return False
 
 
-def update_player(player, delta, walls):
+def update_player(player, delta, wall_grid):
     (left, right) = (key_down("a") or key_down(pg.K_LEFT),
                      key_down("d") or key_down(pg.K_RIGHT))
 
-    is_on_ground = player_is_on_ground(player, walls)
+    is_on_ground = player_is_on_ground(player, wall_grid)
 
     if left and not right:
         player.velocity = (player.velocity[0] - player.walk_acc * delta,
@@ -84,61 +110,325 @@ def update_player(player, delta, walls):
     clamped_horizontal_speed = clamp(player.velocity[0], -max_speed, max_speed)
     player.velocity = (clamped_horizontal_speed, player.velocity[1])
 
-    player.centerx += player.velocity[0] * delta
-    player.centery += player.velocity[1] * delta
+    move_character(player, delta, wall_grid)
 
-def enemy_wall_detector(enemy):
-    size = 10
-    offset = enemy.width / 2
-    if enemy.face_left:
-        offset = -offset
 
-    window = pg.display.get_surface()
-    x = enemy.centerx - size / 2 + offset
-    y = enemy.centery - size / 2
+# Reused when sweeping, instead of making new ones.
+sweep_velocity = Vec2()
+sweep_bounds = AABB()
 
-    return pg.Rect(x, y, size, size)
+def move_character(character, delta, wall_grid):
+    """Moves character by its velocity, without going through any walls."""
+    move_x = character.velocity[0] * delta
+    move_y = character.velocity[1] * delta
+    # Moving less than a quarter of its size it can't get through a wall,
+    # even if it already overlaps one, and the overlap is solved afterwards.
+    # Otherwise sweep it into the walls.
+    if abs(move_x) < character.width / 4 and abs(move_y) < character.height / 4:
+        character.centerx += move_x
+        character.centery += move_y
+        return
 
+    sweep_velocity.set(*character.velocity)
+    walls = wall_grid.query(swept_bounds(character, move_x, move_y, sweep_bounds))
+    move_swept(character, sweep_velocity, delta, walls, bounce=0.1)
+    character.velocity = (sweep_velocity.x, sweep_velocity.y)
 
-def update_enemy(enemy, delta, walls):
-    if enemy.face_left:
-        enemy.velocity = (-enemy.walk_speed,
-                          enemy.velocity[1])
-    else:
-        enemy.velocity = (enemy.walk_speed,
-                          enemy.velocity[1])
+# How big the square in front of an enemy, that makes it turn, is.
+ENEMY_DETECTOR_SIZE = 10
+
+class Patrol:
+    """
+        The stretches of empty tiles between two walls on every row of a
+        level, and which of them each enemy walks on. An enemy turns when
+        its detector reaches the wall at either end, which is a comparison
+        instead of looking at the tiles.
+
+        Rows have the border of empty tiles, like the tiles of the level.
+    """
+
+    def __init__(self, tiles, enemy_count, size, stretches=None):
+        self.size = size
+        if stretches is None:
+            stretches = Patrol.stretches(tiles)
+        # Only read, so they can be shared by every load of the level.
+        self.run_at, self.row, self.left, self.right = stretches
+
+        # The stretch of each enemy. Detectors from low to high are on it,
+        # or on the walls at its ends, and turn at below left or from right.
+        self.enemy_row = np.full(enemy_count, -1)
+        self.enemy_low = np.full(enemy_count, math.inf)
+        self.enemy_high = np.full(enemy_count, -math.inf)
+        self.enemy_left = np.full(enemy_count, math.inf)
+        self.enemy_right = np.full(enemy_count, -math.inf)
+
+    @staticmethod
+    def stretches(tiles):
+        """
+            The stretches of tiles, which only depend on the walls.
+
+            returns -> run_at, row, left, right
+        """
+        run_at = np.full(tiles.shape, -1)
+        rows, lefts, rights = [], [], []
+        for row, walls in enumerate(tiles):
+            # Where the empty stretches start and end, as [start, end).
+            edges = np.flatnonzero(np.diff(np.concatenate(([True], walls, [True])).astype(np.int8)))
+            for start, end in zip(edges[::2], edges[1::2]):
+                run_at[row, start:end] = len(rows)
+                rows.append(row)
+                # Where the walls at the ends start, in pixels. A stretch
+                # going out into the border has no wall at that end.
+                lefts.append((start - 1) * GRID_SIZE if start > 0 else -math.inf)
+                rights.append((end - 1) * GRID_SIZE if end < len(walls) else math.inf)
+        # One extra stretch at the end, for enemies inside a wall, that
+        # nothing is ever on.
+        return (run_at, np.array(rows + [-1]),
+                np.array(lefts + [math.inf], dtype=np.float64),
+                np.array(rights + [-math.inf], dtype=np.float64))
+
+    def _look_up(self, lost, row, center_x):
+        """Internal function that finds the stretch under the center of the lost enemies"""
+        height, width = self.run_at.shape
+        col = (center_x[lost] // GRID_SIZE).astype(int) + 1
+        runs = self.run_at[np.minimum(np.maximum(row[lost], 0), height - 1),
+                           np.minimum(np.maximum(col, 0), width - 1)]
+        self.enemy_row[lost] = self.row[runs]
+        self.enemy_low[lost] = self.left[runs] - GRID_SIZE
+        self.enemy_high[lost] = self.right[runs] + GRID_SIZE - self.size
+        self.enemy_left[lost] = self.left[runs]
+        self.enemy_right[lost] = self.right[runs] - (self.size - 1)
+
+    def turns(self, x, y, center_x):
+        """
+            Which enemies, with detectors at (x, y), hit a wall. Enemies with
+            a detector across two rows, or not on any stretch, can't be told
+            this way.
+
+            returns -> turns, unknown
+        """
+        row = y // GRID_SIZE + 1
+        one_row = row == (y + self.size - 1) // GRID_SIZE + 1
+        known = one_row & (self.enemy_row == row) & (x >= self.enemy_low) & (x <= self.enemy_high)
+        # Enemies that changed row, or walked off their stretch.
+        lost = one_row & ~known
+        if lost.any():
+            self._look_up(lost, row, center_x)
+            known = one_row & (self.enemy_row == row) & (x >= self.enemy_low) & (x <= self.enemy_high)
+        turns = (x < self.enemy_left) ^ (x >= self.enemy_right)
+        return turns, ~known
+
+
+def probe_walls(x, y, size, tiles):
+    """
+        If square detectors of size at (x, y) should turn, once for every
+        wall tile they overlap, like checking the tiles one by one.
+    """
+    # The detector is smaller than a tile, so it overlaps at most two
+    # columns and two rows of them. Anything outside the level ends up on
+    # the empty border of tiles.
+    height, width = tiles.shape
+    edges = np.array([[0], [size - 1]])
+    cols = np.minimum(np.maximum((x + edges) // GRID_SIZE + 1, 0), width - 1)
+    rows = np.minimum(np.maximum((y + edges) // GRID_SIZE + 1, 0), height - 1)
+    walls = tiles[rows[:, None], cols[None, :]]
+    walls[:, 1] &= cols[1] != cols[0]
+    walls[1, :] &= rows[1] != rows[0]
+    # (Tiles, not wall rects, so merged walls count once per tile.)
+    return walls[0, 0] ^ walls[0, 1] ^ walls[1, 0] ^ walls[1, 1]
+
+
+def update_enemies(enemies, delta, level):
+    """Walks all the enemies at once, turning the ones that walk into a wall."""
+    position, velocity, face_left = enemies.position, enemies.velocity, enemies.face_left
+    velocity[:, 0] = np.where(face_left, -Enemy.walk_speed, Enemy.walk_speed)
     # Gravity
-    enemy.velocity = (enemy.velocity[0], enemy.velocity[1] + 500 * delta)
+    velocity[:, 1] += 500 * delta
+
+    move = velocity * delta
+    # The few that move fast enough to go through a wall are swept instead.
+    fast = np.flatnonzero((np.abs(move) >= enemies.size / 4).any(axis=1))
+    move[fast] = 0
+    position += move
+    for index in fast:
+        move_character(enemies[index], delta, level.wall_grid)
+
+    # A small detector in front of each enemy, rounded like a pg.Rect.
+    size = ENEMY_DETECTOR_SIZE
+    offset = enemies.size[:, 0] / 2
+    x = (position[:, 0] - size / 2 + np.where(face_left, -offset, offset)).astype(int)
+    y = (position[:, 1] - size / 2).astype(int)
+
+    turns, unknown = level.patrol.turns(x, y, position[:, 0])
+    # Falling, or somewhere odd, look at the tiles instead.
+    if unknown.any():
+        turns[unknown] = probe_walls(x[unknown], y[unknown], size, level.tiles)
+    face_left ^= turns
+
+
+# What things are, for the broadphase. Everything only looks for the
+# player, so enemies never have to be checked against each other.
+PLAYER, ENEMY, BARR, GOAL = 1, 2, 4, 8
+
+class Contacts:
+    """
+        Everything in a level the player can run into, kept in a broadphase
+        so only the things close to the player are checked. The rects are
+        laid out as the player, all barrs, the goals and then the enemies.
+    """
 
-    enemy.centerx += enemy.velocity[0] * delta
-    enemy.centery += enemy.velocity[1] * delta
+    def __init__(self, enemies, barrs, goals):
+        self.enemies = enemies
+        self.barrs = list(barrs)
+        self.goals = goals
+        self.first_goal = 1 + len(barrs)
+        self.first_enemy = self.first_goal + len(goals)
+
+        self.rects = np.zeros((self.first_enemy + len(enemies), 4))
+        self.rects[1:self.first_goal] = rect_array([pg.Rect(barr) for barr in barrs])
+        self.rects[self.first_goal:self.first_enemy] = rect_array(goals)
+        self.rects[self.first_enemy:, 2:] = enemies.size
+        self.categories = np.array([PLAYER] + [BARR] * len(barrs) + [GOAL] * len(goals)
+                                   + [ENEMY] * len(enemies))
+        self.masks = np.where(self.categories == PLAYER, ENEMY | BARR | GOAL, PLAYER)
+        self.broadphase = SweepAndPrune()
+
+    def near_player(self, player, barrs_left):
+        """
+            The enemies, barrs and goals that overlap or touch the player.
+            Barrs that have been picked up are left out.
+
+            returns -> enemies, barrs, goals
+        """
+        self.rects[0] = (player.centerx, player.centery, player.width, player.height)
+        self.rects[self.first_enemy:, :2] = self.enemies.position
+        self.categories[1:self.first_goal] = [BARR if barr in barrs_left else 0
+                                              for barr in self.barrs]
+        first, second = self.broadphase.pairs(self.rects, self.categories, self.masks)
+        # The player is first in every pair.
+        near = np.sort(second).tolist()
+        return ([self.enemies[i - self.first_enemy] for i in near if i >= self.first_enemy],
+                [self.barrs[i - 1] for i in near if i < self.first_goal],
+                [self.goals[i - self.first_goal] for i in near
+                 if self.first_goal <= i < self.first_enemy])
+
+
+def remember_position(entity):
+    entity.last_centerx = entity.centerx
+    entity.last_centery = entity.centery
+
+
+def pristine_state(player, enemies, barrs):
+    """A copy of everything that changes while playing a level."""
+    return (dict(vars(player)), enemies.state(), list(barrs))
+
+
+def soft_reset(state, player, enemies, barrs):
+    """Puts the player, enemies and barrs back the way they were in state,
+       without loading the level again.
+    """
+    player_state, enemy_state, barr_state = state
+    player.__dict__.clear()
+    player.__dict__.update(player_state)
+    enemies.set_state(enemy_state)
+    barrs[:] = barr_state
+
+
+# How many steps back holding the rewind key can go, at most. Levels
+# with a lot of enemies go back less, to keep the snapshots in
+# REWIND_BYTES.
+REWIND_FRAMES = 1200
+REWIND_BYTES = 16 * 1024 * 1024
+
+def snapshot_layout(barrs):
+    """The layout of a snapshot of a level with these barrs, the enemies
+       go after it.
+    """
+    # The level, the player and if each barr is still left.
+    return struct.Struct("<H6d2?" + "?" * len(barrs))
 
-    wall_detector = enemy_wall_detector(enemy)
 
-    for wall in walls:
-        # Collide
-        normal, depth = overlap_data(wall_detector, wall)
+# Kept between levels, so loading one doesn't make a new buffer when the
+# snapshots are as big as before.
+snapshot_ring = None
+
+def level_snapshots(layout, extra_size):
+    """The snapshot ring for a level, emptied and fitted to layout."""
+    global snapshot_ring
+    frames = min(REWIND_FRAMES, max(1, REWIND_BYTES // (layout.size + extra_size)))
+    if snapshot_ring is None or snapshot_ring.frames != frames:
+        snapshot_ring = SnapshotRing(layout, frames, extra_size)
+    else:
+        snapshot_ring.relayout(layout, extra_size)
+    return snapshot_ring
+
+
+def snapshot_state(snapshots, player, enemies, barrs, all_barrs):
+    """Pushes a snapshot into snapshots, all_barrs being the barrs the
+       level started with.
+    """
+    offset = snapshots.push(current_level,
+                            player.centerx, player.centery, player.velocity[0], player.velocity[1],
+                            player.last_centerx, player.last_centery,
+                            player.face_left, player.has_barr,
+                            *[barr in barrs for barr in all_barrs])
+    enemies.state_into(snapshots.buffer, offset)
+
+
+def restore_state(values, buffer, offset, player, enemies, barrs, all_barrs):
+    """Puts the values of a snapshot back, the enemies from buffer at offset."""
+    global current_level
+    (current_level, player.centerx, player.centery, vel_x, vel_y,
+     player.last_centerx, player.last_centery, player.face_left, player.has_barr) = values[:9]
+    player.velocity = (vel_x, vel_y)
+    enemies.set_state_from(buffer, offset)
+    barrs[:] = [barr for barr, left in zip(all_barrs, values[9:]) if left]
+
 
-        # Turn if hit wall
-        if depth > 0:
-            enemy.face_left = not enemy.face_left
+def interpolated_position(entity, alpha):
+    """Where to draw entity, alpha of the way from its last position."""
+    return (entity.last_centerx + (entity.centerx - entity.last_centerx) * alpha,
+            entity.last_centery + (entity.centery - entity.last_centery) * alpha)
 
-def draw_player(player):
-    window = pg.display.get_surface()
+
+# Sprites are drawn in batch, a higher layer is drawn on top.
+PLAYER_LAYER = 0
+ENEMY_LAYER = 1
+PICKUP_LAYER = 2
+
+def draw_player(player, alpha=1.0):
     if player.has_barr:
         img = assets["myra_med_barr"]
     else:
         img = assets["myra"]
-    if player.face_left:
-        img = pg.transform.flip(img, True, False)
-    draw_transformed(img, (player.centerx, player.centery), (0.1, 0.1))
+    draw_transformed(img, interpolated_position(player, alpha), (0.1, 0.1),
+                     flip=(player.face_left, False), layer=PLAYER_LAYER)
 
-def draw_enemy(enemy):
-    window = pg.display.get_surface()
+def draw_enemy(enemy, alpha=1.0):
     img = assets["myrslok"]
-    if enemy.face_left:
-        img = pg.transform.flip(img, True, False)
-    draw_transformed(img, (enemy.centerx, enemy.centery + GRID_SIZE*0.2), (0.1, 0.1))
+    x, y = interpolated_position(enemy, alpha)
+    draw_transformed(img, (x, y + GRID_SIZE*0.2), (0.1, 0.1),
+                     flip=(enemy.face_left, False), layer=ENEMY_LAYER)
+
+@dataclass
+class Level:
+    walls: list
+    goals: list
+    start: tuple
+    barrs: list
+    enemies: EntityStore
+    # Lookup for the walls close to something.
+    wall_grid: SpatialGrid
+    # How many rects merging the wall tiles got rid of.
+    removed_walls: int = 0
+    # Width and height in pixels.
+    size: tuple = (0, 0)
+    # Which tiles are walls, a bool array with a border of empty tiles
+    # around the level, so tile (x, y) is at [y + 1, x + 1].
+    tiles: object = None
+    # Where the enemies turn around.
+    patrol: Patrol = None
+
 
 levels = [
 """
@@ -219,138 +509,467 @@ levels = [
 ]
 
 
-def parse_level(level_string):
+# Levels are compiled into a small binary form: a header, one byte per
+# tile and then a table for each kind of entity. Loading that is a lot
+# less work than going through the text character by character.
+LEVEL_MAGIC = b"MYRL"
+LEVEL_VERSION = 1
+# Magic, version, width and height in tiles, start tile (-1 if missing),
+# number of goals, barrs and enemies.
+LEVEL_HEADER = struct.Struct("<4sHHHhhHHH")
+# Tile x and y.
+LEVEL_ENTITY = struct.Struct("<HH")
+# Tile x and y, and if it starts out facing left.
+LEVEL_ENEMY = struct.Struct("<HHB")
+TILE_EMPTY = 0
+TILE_WALL = 1
+
+# Extra levels are read from here, after the ones in the levels list.
+LEVEL_DIR = "levels"
+# Compiled levels are kept here, named after the hash of the level text.
+LEVEL_CACHE_DIR = ".levelcache"
+
+
+def compile_level(level_string):
+    """Turns level text into the binary level format."""
+    level_lines = level_string.strip().split("\n")
+    width = max(len(line) for line in level_lines)
+    height = len(level_lines)
 
-    walls = []
+    tiles = bytearray(width * height)
     goals = []
     barrs = []
     enemies = []
-    start = None
-
-    level_lines = level_string.strip().split("\n")
+    start = (-1, -1)
     for tile_y, line in enumerate(level_lines):
-        y = tile_y * GRID_SIZE
         for tile_x, c in enumerate(line):
-            x = tile_x * GRID_SIZE
-            r = pg.Rect(x, y, GRID_SIZE, GRID_SIZE)
             if c == "#":
-                # It's a wall
-                walls.append(r)
+                tiles[tile_y * width + tile_x] = TILE_WALL
             elif c == "E":
-                # It's a goal
-                goals.append(r)
+                goals.append(LEVEL_ENTITY.pack(tile_x, tile_y))
             elif c == "B":
-                # It's a Barr
-                k = (r[0] + GRID_SIZE / 2, r[1]+GRID_SIZE*0.85, r[2], r[3])
-                barrs.append(k)
+                barrs.append(LEVEL_ENTITY.pack(tile_x, tile_y))
             elif c in "XY":
-                # It's an enemy
-                enemy = Enemy()
-                enemy.centerx = r[0] + GRID_SIZE/2
-                enemy.centery = r[1] + GRID_SIZE/2
-                enemies.append(enemy)
-                # Enemies go left or right
-                if c == "X":
-                    enemy.face_left = True
-                    enemy.velocity = (-1, 0)
-                if c == "Y":
-                    enemy.face_left = False
-                    enemy.velocity = (1, 0)
+                enemies.append(LEVEL_ENEMY.pack(tile_x, tile_y, c == "X"))
             elif c == "S":
-                # It's the start
-                start = (x, y)
+                start = (tile_x, tile_y)
+
+    header = LEVEL_HEADER.pack(LEVEL_MAGIC, LEVEL_VERSION, width, height,
+                               start[0], start[1], len(goals), len(barrs), len(enemies))
+    return b"".join([header, tiles] + goals + barrs + enemies)
+
+
+def build_walls(data, width, height, merge_walls):
+    """
+        The walls of compiled level data, and the stretches between them
+        that enemies patrol. Nothing changes them while playing, so they
+        can be shared by every load of the level.
+
+        returns -> wall_map, walls, wall_grid, removed_walls, stretches
+    """
+    wall_map = np.zeros((height + 2, width + 2), dtype=bool)
+    wall_map[1:-1, 1:-1] = np.frombuffer(data, dtype=np.uint8, count=width * height,
+                                         offset=LEVEL_HEADER.size).reshape(height, width) == TILE_WALL
+
+    # In the same order as the tiles, row by row.
+    tile_y, tile_x = np.nonzero(wall_map[1:-1, 1:-1])
+    wall_tiles = list(zip(tile_x.tolist(), tile_y.tolist()))
+    walls = [pg.Rect(x * GRID_SIZE, y * GRID_SIZE, GRID_SIZE, GRID_SIZE) for x, y in wall_tiles]
+
+    removed_walls = 0
+    if merge_walls and walls:
+        merged = merge_tiles(wall_tiles, GRID_SIZE)
+        removed_walls = len(walls) - len(merged)
+        walls = merged
+    return (wall_map, walls, SpatialGrid(GRID_SIZE, walls), removed_walls,
+            Patrol.stretches(wall_map))
+
+
+def build_level(data, merge_walls=None, walls=None):
+    """
+        Makes a Level out of compiled level data, bytes or a mmap. Pass the
+        build_walls of the data as walls to not build them again.
+    """
+    if merge_walls is None:
+        merge_walls = MERGE_WALLS
+
+    (magic, version, width, height, start_x, start_y,
+     num_goals, num_barrs, num_enemies) = LEVEL_HEADER.unpack_from(data)
+    if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+        raise ValueError("Not a compiled level, or compiled by another version")
+
+    offset = LEVEL_HEADER.size
+    if walls is None:
+        walls = build_walls(data, width, height, merge_walls)
+    wall_map, wall_list, wall_grid, removed_walls, stretches = walls
+    offset += width * height
+
+    goals = []
+    for tile_x, tile_y in LEVEL_ENTITY.iter_unpack(data[offset:offset + num_goals * LEVEL_ENTITY.size]):
+        goals.append(pg.Rect(tile_x * GRID_SIZE, tile_y * GRID_SIZE, GRID_SIZE, GRID_SIZE))
+    offset += num_goals * LEVEL_ENTITY.size
+
+    barrs = []
+    for tile_x, tile_y in LEVEL_ENTITY.iter_unpack(data[offset:offset + num_barrs * LEVEL_ENTITY.size]):
+        x, y = tile_x * GRID_SIZE, tile_y * GRID_SIZE
+        barrs.append((x + GRID_SIZE / 2, y + GRID_SIZE*0.85, GRID_SIZE, GRID_SIZE))
+    offset += num_barrs * LEVEL_ENTITY.size
 
-    return walls, goals, start, barrs, enemies
+    enemies = EntityStore(Enemy, max(num_enemies, 1))
+    for tile_x, tile_y, face_left in LEVEL_ENEMY.iter_unpack(data[offset:offset + num_enemies * LEVEL_ENEMY.size]):
+        # Enemies go left or right
+        enemies.add(tile_x * GRID_SIZE + GRID_SIZE/2, tile_y * GRID_SIZE + GRID_SIZE/2,
+                    GRID_SIZE, GRID_SIZE, (-1, 0) if face_left else (1, 0), bool(face_left))
+
+    start = None
+    if start_x >= 0:
+        start = (start_x * GRID_SIZE, start_y * GRID_SIZE)
+
+    return Level(wall_list, goals, start, barrs, enemies, wall_grid, removed_walls,
+                 (width * GRID_SIZE, height * GRID_SIZE), wall_map,
+                 Patrol(wall_map, len(enemies), ENEMY_DETECTOR_SIZE, stretches))
+
+
+def parse_level(level_string, merge_walls=None):
+    return build_level(compile_level(level_string), merge_walls)
+
+
+def level_files():
+    if not os.path.isdir(LEVEL_DIR):
+        return []
+    return sorted(os.path.join(LEVEL_DIR, name)
+                  for name in os.listdir(LEVEL_DIR) if name.endswith(".lvl"))
+
+
+def level_count():
+    return len(levels) + len(level_files())
+
+
+def level_source(index):
+    """The text of a level, from the levels list or a .lvl file."""
+    if index < len(levels):
+        return levels[index]
+    with open(level_files()[index - len(levels)]) as f:
+        return f.read()
+
+
+# Compiled levels that have been loaded, keyed on the hash of their text.
+# Only levels that are played end up here.
+compiled_levels = {}
+
+def compiled_level(index):
+    """The compiled form of a level, compiled only if it isn't on disk."""
+    level_string = level_source(index)
+    # A new version of the format gets new files, instead of reading old ones.
+    key = hashlib.sha1(f"{LEVEL_VERSION}\n{level_string}".encode()).hexdigest()
+    if key in compiled_levels:
+        return compiled_levels[key]
+
+    path = os.path.join(LEVEL_CACHE_DIR, key + ".myrl")
+    data = read_compiled_level(path)
+    if data is None:
+        # Missing, or left broken by a run that was killed, so compile it again.
+        data = compile_level(level_string)
+        try:
+            os.makedirs(LEVEL_CACHE_DIR, exist_ok=True)
+            # Written to the side and moved, so no one reads half a file.
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            # Can't write the cache, just keep it in memory then.
+            pass
+    compiled_levels[key] = data
+    return data
+
+
+def compiled_level_size(data):
+    """How long compiled level data with this header should be."""
+    (magic, version, width, height, _, _,
+     num_goals, num_barrs, num_enemies) = LEVEL_HEADER.unpack_from(data)
+    if magic != LEVEL_MAGIC or version != LEVEL_VERSION:
+        raise ValueError("Not a compiled level, or compiled by another version")
+    return (LEVEL_HEADER.size + width * height + (num_goals + num_barrs) * LEVEL_ENTITY.size
+            + num_enemies * LEVEL_ENEMY.size)
+
+
+def read_compiled_level(path):
+    """The compiled level in path, or None if it's missing or isn't whole."""
+    try:
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        # An empty file can't be mapped.
+        return None
+    try:
+        if len(data) == compiled_level_size(data):
+            return data
+    except (ValueError, struct.error):
+        pass
+    data.close()
+    return None
+
+
+# The build_walls of the compiled levels, by the id of their data, which
+# stays in compiled_levels for good.
+level_walls = {}
+
+def load_level(index):
+    """Loads level number index, only compiling and building what's needed."""
+    data = compiled_level(index)
+    key = (id(data), MERGE_WALLS)
+    if key not in level_walls:
+        width, height = LEVEL_HEADER.unpack_from(data)[2:4]
+        level_walls[key] = build_walls(data, width, height, MERGE_WALLS)
+    return build_level(data, MERGE_WALLS, level_walls[key])
+
+
+def wall_merge_report():
+    """Prints how many wall rects merging saves on every level."""
+    for index, level_string in enumerate(levels):
+        tiles = len(parse_level(level_string, merge_walls=False).walls)
+        removed = parse_level(level_string, merge_walls=True).removed_walls
+        print(f"Level {index + 1}: {tiles} wall tiles -> {tiles - removed} rects "
+              f"({removed} removed)")
+
+
+# The walls never move, so each level is drawn once and then reused.
+# Keyed on the level index, so a restart doesn't redraw it.
+level_backgrounds = {}
+
+def render_level_background(walls, size):
+    background = pg.Surface(size).convert()
+    background.fill(SKY_COLOR)
+    for wall in walls:
+        pg.draw.rect(background, WALL_COLOR, wall)
+    return background
+
+
+def level_background(index, level, size):
+    # Only drawn when it's first needed, so headless runs never draw it.
+    if index not in level_backgrounds:
+        level_backgrounds[index] = render_level_background(level.walls, size)
+    return level_backgrounds[index]
 
 
 def init():
     """ A function for loading all your assets.
         (Audio assets can at their earliest be loaded here.)
     """
-    # Load images here
-    assets["barr"]          = pg.image.load("res/barr.png")
-    assets["myra"]          = pg.image.load("res/myra.png")
-    assets["myra_med_barr"] = pg.image.load("res/myra_med_barr.png")
-    assets["myrstack"]      = pg.image.load("res/myrstack.png")
-    assets["myrslok"]      = pg.image.load("res/myrslok.png")
-    assets["teapot"]        = pg.image.load("res/teapot.png")
+    # Images and sounds load in the background, with a loading screen.
+    # The sprites are never drawn bigger than this, so they're shrunk now.
+    load_manifest({
+        "barr":          ("res/barr.png", 0.1),
+        "myra":          ("res/myra.png", 0.1),
+        "myra_med_barr": ("res/myra_med_barr.png", 0.1),
+        "myrstack":      ("res/myrstack.png", 0.07),
+        "myrslok":       ("res/myrslok.png", 0.1),
+        "teapot":        "res/teapot.png",
+        "plong":         "res/plong.wav",
+        "pickup":        "res/PlockaBarr.wav",
+        "death":         "res/Deathnoise.wav",
+        "win":           "res/Hurramyror.wav",
+    }, into=assets, on_done=assets_loaded)
+
+
+def assets_loaded():
+    # Pack the sprites the way they're drawn, so a frame is one big blit.
+    for name in ("myra", "myra_med_barr", "myrslok"):
+        for face_left in (False, True):
+            add_to_atlas(assets[name], (0.1, 0.1), flip=(face_left, False))
+    add_to_atlas(assets["barr"], (0.1, 0.1))
+    add_to_atlas(assets["myrstack"], (0.07, 0.07))
+    pack_atlas()
+    set_batch_drawing(True)
+    # The background never changes, so only what moves has to be sent.
+    set_dirty_rects(True)
+
+
+# With more enemies than this, their walls are solved all at once.
+BATCH_ENEMIES = 32
+
+def resolve_wall_collisions(player, enemies, level, velocity):
+    # Solving all at once only knows about wall tiles, not merged walls.
+    if len(enemies) >= BATCH_ENEMIES and not level.removed_walls:
+        resolve_enemy_wall_collisions(enemies, level.tiles)
+        characters = [player]
+    else:
+        characters = [player, *enemies]
 
-    # Load sounds here
-    assets["plong"] = pg.mixer.Sound("res/plong.wav")
-    assets["background"] = pg.mixer.music.load("res/backgroundmusic.mp3")
+    for character in characters:
+        velocity.set(*character.velocity)
+        # Walls further away than this can't be pushed into this frame.
+        for wall in level.wall_grid.query(character, margin=GRID_SIZE):
+            solve_overlap_into(character, wall, velocity, mass_b=0, bounce=0.1)
+        character.velocity = (velocity.x, velocity.y)
 
 
+def resolve_enemy_wall_collisions(enemies, tiles):
+    """
+        The same as resolve_wall_collisions for every enemy, but all of
+        them at once. Goes through the tiles around the enemies in the same
+        order as the wall grid gives them.
+    """
+    if not len(enemies):
+        return
+    rects = enemies.rects()
+    velocity = enemies.velocity
+    # The cells wall_grid.query(enemy, margin=GRID_SIZE) looks in. A wall
+    # touches the cell to its right and below too, so start one tile early.
+    half = rects[:, 2:] / 2 + GRID_SIZE
+    first = np.floor((rects[:, :2] - half) / GRID_SIZE).astype(int) - 1
+    last = np.floor((rects[:, :2] + half) / GRID_SIZE).astype(int)
+    span_x, span_y = (last - first).max(axis=0) + 1
+
+    height, width = tiles.shape
+    statics = np.full_like(rects, GRID_SIZE)
+    for step_y in range(span_y):
+        for step_x in range(span_x):
+            tile = first + (step_x, step_y)
+            walls = (tiles[np.minimum(np.maximum(tile[:, 1] + 1, 0), height - 1),
+                           np.minimum(np.maximum(tile[:, 0] + 1, 0), width - 1)]
+                     & (tile[:, 0] <= last[:, 0]) & (tile[:, 1] <= last[:, 1]))
+            if not walls.any():
+                continue
+            statics[:, :2] = tile * GRID_SIZE + GRID_SIZE / 2
+            solve_rect_overlap_pairs(rects, velocity, statics, mass=1, bounce=0.1, pairs=walls)
+    enemies.position[:] = rects[:, :2]
+
+
+def draw_level(background, player, enemies, barrs, goals, alpha):
+    draw_background(background)
+    draw_player(player, alpha)
+
+    for enemy in enemies:
+        draw_enemy(enemy, alpha)
+
+    for barr in barrs:
+        draw_transformed(assets["barr"], barr, (0.1, 0.1), layer=PICKUP_LAYER)
+
+    for goal in goals:
+        shifted_pos = (goal[0]+GRID_SIZE/2, goal[1]+GRID_SIZE*0.7, goal[2], goal[2])
+        draw_transformed(assets["myrstack"], shifted_pos, (0.07, 0.07), layer=PICKUP_LAYER)
+
+    draw_text(f"Level: {current_level + 1}", (0, 0))
+
+
+def describe_state(player, enemies, barrs):
+    """Everything that changes while playing, for checking replays."""
+    return repr((current_level,
+                 player.centerx, player.centery, player.velocity,
+                 player.face_left, player.has_barr,
+                 [(e.centerx, e.centery, e.velocity, e.face_left) for e in enemies],
+                 barrs))
+
+
+# Streamed from the disk, not loaded with the other assets.
+MUSIC = "res/backgroundmusic.mp3"
+
+# A sound with a higher priority can cut off one with a lower.
+PICKUP_PRIORITY = 1
+DEATH_PRIORITY = 2
+WIN_PRIORITY = 3
+
 current_level = 0
 def update():
     """The program starts here"""
     global current_level
-    # Initialization (only runs on start/restart)
+    # Initialization (only runs on start/restart, which is when the
+    # level changes. Dying only resets the things that move.)
     player = Player()
-    pg.mixer.music.play()
-
-    walls, goals, start, barrs, enemies = parse_level(levels[current_level])
+    # Keeps playing if it already is, so it doesn't start over every level.
+    play_music(MUSIC)
+
+    # The step that reaches a goal still draws this level after
+    # current_level has moved on.
+    level_index = current_level
+    level = load_level(level_index)
+    # Only this label and the next, which is drawn when the goal is
+    # reached, so a big level pack doesn't render a label per level.
+    next_index = (level_index + 1) % level_count()
+    prewarm_text(f"Level: {index + 1}" for index in (level_index, next_index))
+    goals, barrs, enemies = level.goals, level.barrs, level.enemies
+    start = level.start
     player.centerx = start[0]
     player.centery = start[1]
-
-    level_lines = levels[current_level].splitlines()[1:]
-    width = len(level_lines[1]) * GRID_SIZE
-    height = len(level_lines) * GRID_SIZE
-    pg.display.set_mode((width, height))
+    remember_position(player)
+
+    width, height = level.size
+    # Making a new window is slow, only do it if the size changes.
+    screen = pg.display.get_surface()
+    if screen is None or screen.get_size() != (width, height):
+        pg.display.set_mode((width, height))
+
+    velocity = Vec2()
+    set_state_hash(lambda: describe_state(player, enemies, barrs))
+    pristine = pristine_state(player, enemies, barrs)
+    all_barrs = pristine[2]
+    dead = False
+    snapshots = level_snapshots(snapshot_layout(barrs), enemies.state_size())
+    contacts = Contacts(enemies, barrs, goals)
 
     # Main update loop
     while True:
-        clear_screen(pg.Color(170, 180, 255))
-        update_player(player, delta(), walls)
-        draw_player(player)
-
-        for wall in walls:
-            window = pg.display.get_surface()
-            pg.draw.rect(window, pg.Color(110, 40, 0), wall)
-
-            for character in [player] + enemies:
-                entity_vel, wall_vel, overlap, _ = solve_rect_overlap(character,
-                                                                      wall,
-                                                                      character.velocity,
-                                                                      mass_b=0,
-                                                                      bounce=0.1)
-                character.velocity = entity_vel
-
-        for enemy in enemies:
-            update_enemy(enemy, delta(), walls)
-            draw_enemy(enemy)
-            _, depth = overlap_data(player, enemy)
-            if depth > 0:
-                player.velocity = (0, 0)
-                restart()
-
-        for barr in barrs:
-            window = pg.display.get_surface()
-            draw_transformed(assets["barr"], barr, (0.1, 0.1))
-
-            normal, depth = overlap_data(player, pg.Rect(barr))
-            if depth > 0 and not player.has_barr:
-                player.has_barr = True
-                barrs.remove(barr)
-
-        for goal in goals:
-            window = pg.display.get_surface()
-            shifted_pos = (goal[0]+GRID_SIZE/2, goal[1]+GRID_SIZE*0.7, goal[2], goal[2])
-            draw_transformed(assets["myrstack"], shifted_pos, (0.07, 0.07))
-
-            normal, depth = overlap_data(player, goal)
-            if depth > 0:
-                # If carrying a barr - drop it in the stack!
-                player.has_barr = False
-                # Can't win if there's barr in the world!
-                if barrs:
-                    continue
-                current_level = (current_level + 1) % len(levels)
-                restart()
-
-        draw_text(f"Level: {current_level + 1}", (0, 0))
-
-        if key_down("q") or key_down(pg.K_ESCAPE):
-            break
+        if dead:
+            soft_reset(pristine, player, enemies, barrs)
+            dead = False
+
+        if simulating() and key_down("r"):
+            # Holding r goes back in time, a step at a time.
+            if snapshots:
+                offset = snapshots.extra_offset()
+                restore_state(snapshots.pop(), snapshots.buffer, offset,
+                              player, enemies, barrs, all_barrs)
+        elif simulating():
+            snapshot_state(snapshots, player, enemies, barrs, all_barrs)
+            dt = delta()
+            remember_position(player)
+            enemies.remember_positions()
+
+            update_player(player, dt, level.wall_grid)
+            with perf_scope("collision"):
+                resolve_wall_collisions(player, enemies, level, velocity)
+
+            with perf_scope("enemies"):
+                update_enemies(enemies, dt, level)
+
+            with perf_scope("contacts"):
+                near_enemies, near_barrs, near_goals = contacts.near_player(player, barrs)
+
+            for enemy in near_enemies:
+                if overlap_into(player, enemy) > 0 and not dead:
+                    player.velocity = (0, 0)
+                    play_sound(assets["death"], DEATH_PRIORITY)
+                    # Reset before the next step.
+                    dead = True
+
+            for barr in near_barrs:
+                normal, depth = overlap_data(player, pg.Rect(barr))
+                if depth > 0 and not player.has_barr:
+                    player.has_barr = True
+                    barrs.remove(barr)
+                    play_sound(assets["pickup"], PICKUP_PRIORITY)
+
+            for goal in near_goals:
+                normal, depth = overlap_data(player, goal)
+                if depth > 0:
+                    # If carrying a barr - drop it in the stack!
+                    if player.has_barr:
+                        play_sound(assets["plong"], PICKUP_PRIORITY)
+                    player.has_barr = False
+                    # Can't win if there's barr in the world!
+                    if barrs:
+                        continue
+                    play_sound(assets["win"], WIN_PRIORITY)
+                    current_level = (current_level + 1) % level_count()
+                    restart()
+
+            if key_down("q") or key_down(pg.K_ESCAPE):
+                break
+
+        if rendering():
+            background = level_background(level_index, level, (width, height))
+            draw_level(background, player, enemies, barrs, goals, alpha())
 
         # Main loop ends here, put your code above this line
         yield
@@ -358,4 +977,6 @@ def update():
 
 # This has to be at the bottom, because of python reasons.
 if __name__ == "__main__":
+   # Physics runs at a steady 120 steps per second, however fast we draw.
+   set_simulation_rate(120)
    start_game(init, update)
@@ -23,6 +23,22 @@ import pygame as pg
 
 # math has sin, cos and other interesting things.
 import math
+import os
+import struct
+import hashlib
+import json
+import cProfile
+import weakref
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import perf_counter
+
+# numpy is only needed for the batched physics, so it's optional.
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 #
 # Input handling
@@ -33,21 +49,206 @@ def _event_is(event: pg.event, kind: str) -> bool:
     return pg.event.event_name(event.type) == kind
 
 
+class LiveInput:
+    """Reads the buttons from the keyboard, through pygame's events."""
+
+    def poll(self, held):
+        """Updates the set of held buttons, returns False if the game should quit."""
+        running = True
+        for event in pg.event.get():
+            if _event_is(event, "Quit"):
+                running = False
+            elif _event_is(event, "KeyDown"):
+                held.add(event.key)
+            elif _event_is(event, "KeyUp"):
+                if event.key in held:
+                    held.remove(event.key)
+        return running
+
+
+class ScriptedInput:
+    """
+        Plays back a script instead of reading the keyboard. The script is
+        either a list with the held buttons for each frame, or a function
+        that takes the frame number and returns the held buttons.
+        The game quits when a list runs out, or when the function returns None.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self.frame = 0
+
+    def poll(self, held):
+        if callable(self.script):
+            keys = self.script(self.frame)
+        elif self.frame < len(self.script):
+            keys = self.script[self.frame]
+        else:
+            keys = None
+        self.frame += 1
+        if keys is None:
+            return False
+        held.clear()
+        held.update(_to_keycode(key) for key in keys)
+        # Still let the window be closed.
+        for event in pg.event.get():
+            if _event_is(event, "Quit"):
+                return False
+        return True
+
+
+class ReplayMismatch(Exception):
+    """Raised when a replay doesn't end up where the recording did."""
+
+
+# Layout of recorded input files:
+#   header - magic, version and the length of a step in seconds.
+#   frames - a count of held buttons, then that many keycodes,
+#            or _SAME_AS_LAST if nothing changed since the frame before.
+#   footer - _STATE_HASH, the length of the hash and the hash itself.
+_RECORDING_HEADER = struct.Struct("<4sHd")
+_RECORDING_MAGIC = b"RIBS"
+_RECORDING_VERSION = 1
+_SAME_AS_LAST = 0xFF
+_STATE_HASH = 0xFE
+_MAX_HELD = 0xFD
+
+
+class InputRecorder:
+    """
+        Wraps another input source and writes the held buttons for every
+        frame to a file, which InputReplay can play back.
+    """
+
+    def __init__(self, path, source=None):
+        self.source = LiveInput() if source is None else source
+        self.file = open(path, "wb")
+        self.file.write(_RECORDING_HEADER.pack(_RECORDING_MAGIC,
+                                               _RECORDING_VERSION,
+                                               delta()))
+        self.last = None
+        self.frames = 0
+
+    def poll(self, held):
+        running = self.source.poll(held)
+        if not running:
+            # The game never simulates this frame, so don't record it.
+            return False
+        if held == self.last:
+            self.file.write(bytes((_SAME_AS_LAST,)))
+        else:
+            keys = sorted(held)[:_MAX_HELD]
+            self.file.write(struct.pack(f"<B{len(keys)}I", len(keys), *keys))
+            self.last = set(held)
+        self.frames += 1
+        return True
+
+    def finish(self, state_hash=None):
+        """Ends the recording, storing the hash of the final state."""
+        if self.file.closed:
+            return
+        if state_hash is not None:
+            self.file.write(bytes((_STATE_HASH, len(state_hash))) + state_hash)
+        self.file.close()
+
+
+class InputReplay:
+    """
+        Plays back a file written by InputRecorder, one recorded frame per
+        frame. When the replay finishes, the final state is checked against
+        the recorded hash.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        magic, version, self.step = _RECORDING_HEADER.unpack_from(self.data)
+        if magic != _RECORDING_MAGIC or version != _RECORDING_VERSION:
+            raise ValueError(f"{path} is not a ribs input recording")
+        self.offset = _RECORDING_HEADER.size
+        self.expected_hash = None
+        self.frames = 0
+
+    def poll(self, held):
+        if self.frames == 0 and abs(self.step - delta()) > 1e-9:
+            raise ReplayMismatch(f"Recorded with steps of {self.step} seconds, "
+                                 f"but replaying with {delta()}")
+        data = self.data
+        if self.offset >= len(data):
+            return False
+        count = data[self.offset]
+        self.offset += 1
+        if count == _STATE_HASH:
+            length = data[self.offset]
+            self.expected_hash = data[self.offset + 1:self.offset + 1 + length]
+            self.offset = len(data)
+            return False
+        if count != _SAME_AS_LAST:
+            held.clear()
+            held.update(struct.unpack_from(f"<{count}I", data, self.offset))
+            self.offset += 4 * count
+        self.frames += 1
+        # Still let the window be closed.
+        for event in pg.event.get():
+            if _event_is(event, "Quit"):
+                return False
+        return True
+
+    def finish(self, state_hash=None):
+        """Checks that the replay ended up in the same state as the recording."""
+        if self.expected_hash is None or state_hash is None:
+            return
+        if self.offset < len(self.data) or state_hash != self.expected_hash:
+            raise ReplayMismatch(f"The replay differs from the recording "
+                                 f"after {self.frames} frames")
+
+
+INPUT_SOURCE = LiveInput()
+def set_input_source(source):
+    """
+        Changes where the held buttons come from, source has a poll(held)
+        method. None goes back to reading the keyboard.
+    """
+    global INPUT_SOURCE
+    INPUT_SOURCE = LiveInput() if source is None else source
+
+
+STATE_HASH_FUNC = None
+def set_state_hash(func):
+    """
+        Tells ribs how to describe the state of the game, func returns bytes
+        or a string. Recordings store a hash of it, and replays check it.
+    """
+    global STATE_HASH_FUNC
+    STATE_HASH_FUNC = func
+
+
+def state_hash():
+    """Returns a hash of the state of the game, or None if it's not known."""
+    if STATE_HASH_FUNC is None:
+        return None
+    state = STATE_HASH_FUNC()
+    if isinstance(state, str):
+        state = state.encode()
+    return hashlib.sha256(state).digest()
+
+
+def _finish_input():
+    """Internal function that lets the input source know the game is over"""
+    finish = getattr(INPUT_SOURCE, "finish", None)
+    if finish is not None:
+        finish(state_hash())
+
+
 current_frame_held_buttons = set()
-last_frame_held_buttons = None
+last_frame_held_buttons = set()
 def process_events():
     """Tells the game what buttons are pressed."""
-    running = True
     global last_frame_held_buttons
     last_frame_held_buttons = current_frame_held_buttons.copy()
-    for event in pg.event.get():
-        if _event_is(event, "Quit"):
-            running = False
-        elif _event_is(event, "KeyDown"):
-            current_frame_held_buttons.add(event.key)
-        elif _event_is(event, "KeyUp"):
-            if event.key in current_frame_held_buttons:
-                current_frame_held_buttons.remove(event.key)
+    running = INPUT_SOURCE.poll(current_frame_held_buttons)
+    if key_pressed(PERF_OVERLAY_KEY):
+        set_perf_overlay(not PERF_OVERLAY)
     return running
 
 
@@ -98,58 +299,918 @@ def key_pressed(key):
 # Simple sprite drawing
 #
 
-def draw_transformed(img, position, scale=(1., 1.), degrees=0):
+def _surface_bytes(surface):
+    """Internal function to estimate how much memory a surface uses"""
+    w, h = surface.get_size()
+    return w * h * surface.get_bytesize()
+
+
+class _SurfaceCache:
     """
-        Draw img centered at position, scale the image and then rotate it in
-        degrees before drawing.
+        Internal least recently used cache for surfaces. The cache is bounded
+        by the number of bytes the stored surfaces use, when it's full the
+        surface that was used the longest time ago is thrown away.
     """
-    if scale[0] != 1. or scale[1] != 1.:
-        w, h = img.get_size()
-        w = int(w * scale[0])
-        h = int(h * scale[1])
-        img = pg.transform.scale(img, (w, h))
+
+    def __init__(self, max_bytes, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """Returns the surface stored for key, or None if there is none."""
+        surface = self._entries.get(key)
+        if surface is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return surface
+
+    def put(self, key, surface):
+        """Stores surface under key, evicting old surfaces if needed."""
+        size = _surface_bytes(surface)
+        if size > self.max_bytes:
+            # It would throw out everything else, so don't bother.
+            return surface
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.used_bytes -= _surface_bytes(old)
+        self._entries[key] = surface
+        self.used_bytes += size
+        self._shrink()
+        return surface
+
+    def discard(self, key):
+        """Throws away the surface stored under key, if there is one."""
+        surface = self._entries.pop(key, None)
+        if surface is not None:
+            self.used_bytes -= _surface_bytes(surface)
+
+    def resize(self, max_bytes):
+        """Changes the memory budget, evicting surfaces if needed."""
+        self.max_bytes = max_bytes
+        self._shrink()
+
+    def clear(self):
+        """Throws away all stored surfaces, but keeps the counters."""
+        self._entries.clear()
+        self.used_bytes = 0
+
+    def stats(self):
+        """Returns a dict with the cache counters."""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.used_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _shrink(self):
+        while self.used_bytes > self.max_bytes and self._entries:
+            key, evicted = self._entries.popitem(last=False)
+            self.used_bytes -= _surface_bytes(evicted)
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(key)
+
+
+def _evicted_transform(key):
+    """Internal function that forgets a key the transform cache threw away"""
+    keys = TRANSFORMED_FROM.get(key[0])
+    if keys is not None:
+        keys.discard(key)
+
+
+def _forget_source(source_id):
+    """Internal function that throws away the transforms of an image that is gone"""
+    for key in TRANSFORMED_FROM.pop(source_id, ()):
+        TRANSFORM_CACHE.discard(key)
+
+
+# Scaling and rotating images is slow, and most games draw the same
+# image with the same transform every frame. So we remember the results.
+TRANSFORM_CACHE = _SurfaceCache(32 * 1024 * 1024, on_evict=_evicted_transform)
+# The cached keys of each image, by id. The keys don't keep the images
+# alive, when an image is gone its transforms are thrown away too.
+TRANSFORMED_FROM = {}
+
+
+def _transform_key(img, scale, degrees, flip):
+    """Internal function that gives the key a transformed image is stored under"""
+    # Images shrunk by load_image are scaled as if they were still full size.
+    loaded_scale = IMAGE_SCALES.get(img, 1.)
+    return (id(img), scale[0] / loaded_scale, scale[1] / loaded_scale,
+            degrees, bool(flip[0]), bool(flip[1]))
+
+
+def _transform(img, scale_x, scale_y, degrees, flip_x, flip_y):
+    """Internal function that flips, scales and rotates img without caching"""
+    transformed = img
+    if flip_x or flip_y:
+        transformed = pg.transform.flip(transformed, flip_x, flip_y)
+    if scale_x != 1. or scale_y != 1.:
+        w, h = transformed.get_size()
+        w = int(w * scale_x)
+        h = int(h * scale_y)
+        transformed = pg.transform.scale(transformed, (w, h))
     if degrees:
         # Pygame rotates CCW in degrees, for some reason.
-        img = pg.transform.rotate(img, -degrees)
+        transformed = pg.transform.rotate(transformed, -degrees)
+    return transformed
+
+
+def transform_image(img, scale=(1., 1.), degrees=0, flip=(False, False)):
+    """
+        Returns img flipped, scaled and then rotated in degrees. The result
+        is cached, so calling this every frame with the same arguments is cheap.
+    """
+    key = _transform_key(img, scale, degrees, flip)
+    if key[1] == 1. and key[2] == 1. and not degrees and not key[4] and not key[5]:
+        return img
+
+    transformed = TRANSFORM_CACHE.get(key)
+    if transformed is not None:
+        return transformed
+    keys = TRANSFORMED_FROM.get(key[0])
+    if keys is None:
+        keys = TRANSFORMED_FROM[key[0]] = set()
+        weakref.finalize(img, _forget_source, key[0])
+    keys.add(key)
+    return TRANSFORM_CACHE.put(key, _transform(img, *key[1:]))
+
+
+def set_transform_cache_size(max_bytes):
+    """Sets how many bytes of transformed images are kept in memory."""
+    TRANSFORM_CACHE.resize(max_bytes)
+
+
+def clear_transform_cache():
+    """
+        Forgets all transformed images. Call this if you draw on an image
+        that has already been drawn with draw_transformed.
+    """
+    TRANSFORM_CACHE.clear()
+    for keys in TRANSFORMED_FROM.values():
+        keys.clear()
+
+
+def transform_cache_stats():
+    """Returns a dict with hits, misses and memory use of the transform cache."""
+    return TRANSFORM_CACHE.stats()
+
+
+class TextureAtlas:
+    """
+        Lots of small images packed into one big surface. The images are
+        stored already flipped, scaled and rotated, so drawing them is just
+        copying a part of the big surface.
+    """
+
+    def __init__(self, max_width=2048, padding=1):
+        self.max_width = max_width
+        self.padding = padding
+        self.surface = None
+        self.regions = {}
+        self._images = OrderedDict()
+        # The keys are ids, so the images are kept while they're packed.
+        self._sources = {}
+
+    def __len__(self):
+        return len(self.regions)
+
+    def add(self, img, scale=(1., 1.), degrees=0, flip=(False, False)):
+        """Adds img, transformed like draw_transformed would, to the next pack."""
+        key = _transform_key(img, scale, degrees, flip)
+        if key not in self._images:
+            self._images[key] = _transform(img, *key[1:])
+            self._sources[key[0]] = img
+
+    def pack(self):
+        """
+            Packs all added images into one surface, in rows sorted from
+            the tallest image to the shortest.
+        """
+        pad = self.padding
+        ordered = sorted(self._images.items(), key=lambda item: -item[1].get_height())
+        widest = max((img.get_width() for _, img in ordered), default=0)
+        total = sum(img.get_width() + pad for _, img in ordered)
+        width = max(widest, min(self.max_width, total))
+
+        regions = {}
+        x = y = row_height = 0
+        for key, img in ordered:
+            w, h = img.get_size()
+            if x + w > width:
+                x = 0
+                y += row_height + pad
+                row_height = 0
+            regions[key] = pg.Rect(x, y, w, h)
+            x += w + pad
+            row_height = max(row_height, h)
+
+        self.surface = pg.Surface((width, max(y + row_height, 1)), pg.SRCALPHA)
+        for key, img in ordered:
+            # Max against the transparent atlas copies the pixels as they are,
+            # a normal blit would blend the alpha twice.
+            self.surface.blit(img, regions[key], special_flags=pg.BLEND_RGBA_MAX)
+        self.regions = regions
+
+    def find(self, key):
+        """Returns where the image stored under key is, or None if it isn't packed."""
+        return self.regions.get(key)
+
+    def stats(self):
+        """Returns a dict with the number of images and memory use of the atlas."""
+        return {
+            "entries": len(self.regions),
+            "size": self.surface.get_size() if self.surface else (0, 0),
+            "bytes": _surface_bytes(self.surface) if self.surface else 0,
+        }
+
+
+# The images draw_transformed looks for first in batch mode.
+SPRITE_ATLAS = TextureAtlas()
+
+# In batch mode nothing is drawn right away, the draws are collected here
+# per layer and all drawn with one blits call at the end of the frame.
+# None means immediate mode.
+SPRITE_BATCH = None
+# Text is drawn on top of the sprites.
+TEXT_LAYER = 1000
+
+
+def add_to_atlas(img, scale=(1., 1.), degrees=0, flip=(False, False)):
+    """
+        Packs img with the given transform into the sprite atlas the next
+        time pack_atlas is called. Call it in init for the images you draw.
+    """
+    SPRITE_ATLAS.add(img, scale, degrees, flip)
+
+
+def pack_atlas():
+    """Packs the images added with add_to_atlas into the sprite atlas."""
+    SPRITE_ATLAS.pack()
+
+
+def set_batch_drawing(batch):
+    """
+        In batch mode draw_transformed and draw_text only remember what to
+        draw, and it's all drawn at the end of the frame, one layer at a
+        time. Things drawn in other ways end up beneath them.
+    """
+    global SPRITE_BATCH
+    if not batch:
+        draw_sprite_batch()
+        SPRITE_BATCH = None
+    elif SPRITE_BATCH is None:
+        SPRITE_BATCH = {}
+
+
+def draw_sprite_batch():
+    """Draws everything collected in batch mode, lowest layer first."""
+    if not SPRITE_BATCH:
+        return
+    blits = []
+    for layer in sorted(SPRITE_BATCH):
+        blits += SPRITE_BATCH[layer]
+    SPRITE_BATCH.clear()
+    if HEADLESS: return
+    drawn = pg.display.get_surface().blits(blits, doreturn=DIRTY_RECTS)
+    if DIRTY_RECTS:
+        _DIRTY.extend(drawn)
+
+
+def _batch(layer, blit):
+    """Internal function that remembers a blit until the batch is drawn"""
+    draws = SPRITE_BATCH.get(layer)
+    if draws is None:
+        draws = SPRITE_BATCH[layer] = []
+    draws.append(blit)
+
+
+def draw_transformed(img, position, scale=(1., 1.), degrees=0, flip=(False, False), layer=0):
+    """
+        Draw img centered at position, scale the image and then rotate it in
+        degrees before drawing. The image can also be flipped along the
+        x and y axis. In batch mode higher layers are drawn on top.
+    """
+    if HEADLESS: return
+    if SPRITE_BATCH is not None:
+        region = SPRITE_ATLAS.find(_transform_key(img, scale, degrees, flip))
+        if region is not None:
+            _batch(layer, (SPRITE_ATLAS.surface,
+                           (int(position[0] - region.w / 2.0), int(position[1] - region.h / 2.0)),
+                           region))
+            return
+    img = transform_image(img, scale, degrees, flip)
     w, h = img.get_size()
-    window = pg.display.get_surface()
-    window.blit(img, (int(position[0] - w / 2.0), int(position[1] - h / 2.0)))
+    top_left = (int(position[0] - w / 2.0), int(position[1] - h / 2.0))
+    if SPRITE_BATCH is not None:
+        _batch(layer, (img, top_left))
+    else:
+        _mark_dirty(pg.display.get_surface().blit(img, top_left))
+
+
+# With dirty rects on, only the parts of the window that were drawn on
+# are sent to the display. What's drawn is remembered here, and put back
+# from the background the next frame.
+DIRTY_RECTS = False
+DIRTY_MAX_AREA = 0.5
+_DIRTY = []
+_LAST_DIRTY = []
+_DIRTY_BACKGROUND = None
+_FULL_REDRAW = True
+
+
+def set_dirty_rects(dirty_rects, max_area=0.5):
+    """
+        Turns dirty rects on or off. With them on, only what was drawn this
+        frame and the last is sent to the display, and the screen isn't
+        cleared between frames. So draw_background has to be called first
+        every frame, and everything else drawn with the ribs functions.
+        If more than max_area of the window changed, all of it is sent.
+    """
+    global DIRTY_RECTS, DIRTY_MAX_AREA
+    DIRTY_RECTS = dirty_rects
+    DIRTY_MAX_AREA = max_area
+    _redraw_all()
+
+
+def _redraw_all():
+    """Internal function that makes the next frame send the whole window"""
+    global _FULL_REDRAW, _DIRTY_BACKGROUND
+    _FULL_REDRAW = True
+    _DIRTY_BACKGROUND = None
+    _DIRTY.clear()
+    _LAST_DIRTY.clear()
+
+
+def _mark_dirty(rect):
+    """Internal function that remembers a part of the window that was drawn on"""
+    if DIRTY_RECTS:
+        _DIRTY.append(rect)
+
+
+def _present():
+    """Internal function that shows the frame, only the parts that changed with dirty rects"""
+    global _FULL_REDRAW, _DIRTY, _LAST_DIRTY
+    if not DIRTY_RECTS:
+        pg.display.flip()
+        return
+    w, h = pg.display.get_surface().get_size()
+    changed = _LAST_DIRTY + _DIRTY
+    if _FULL_REDRAW or sum(rect.w * rect.h for rect in changed) > DIRTY_MAX_AREA * w * h:
+        pg.display.flip()
+    else:
+        pg.display.update(changed)
+    _LAST_DIRTY, _DIRTY = _DIRTY, _LAST_DIRTY
+    _DIRTY.clear()
+    _FULL_REDRAW = False
 
 
 def clear_screen(color):
     """Fill the screen with color"""
+    global _FULL_REDRAW
+    if HEADLESS: return
     window = pg.display.get_surface()
     top_left = (0, 0)
     bottom_right = pg.display.get_surface().get_size()
     pg.draw.rect(window, color, (top_left, bottom_right))
+    _FULL_REDRAW = True
+
+
+def draw_background(img):
+    """
+        Fill the screen with img, drawn from the top left corner. This is a
+        lot faster than redrawing things that never move every frame.
+        With dirty rects only what was drawn over last frame is put back.
+    """
+    global _DIRTY_BACKGROUND, _FULL_REDRAW
+    if HEADLESS: return
+    window = pg.display.get_surface()
+    if DIRTY_RECTS and img is _DIRTY_BACKGROUND and not _FULL_REDRAW:
+        window.blits([(img, rect, rect) for rect in _LAST_DIRTY], doreturn=False)
+        return
+    window.blit(img, (0, 0))
+    _DIRTY_BACKGROUND = img
+    _FULL_REDRAW = True
+
+#
+# Asset loading
+#
+
+class AssetBudgetExceeded(Exception):
+    """Raised when loading an image would go over the asset budget."""
+
+
+# How many bytes the images from load_image may use together.
+ASSET_BUDGET = 64 * 1024 * 1024
+# Everything load_image has loaded, by path.
+LOADED_IMAGES = OrderedDict()
+LOADED_IMAGE_BYTES = 0
+# How much smaller than its file each loaded image is.
+IMAGE_SCALES = {}
+
+
+def _decode_image(path, max_scale):
+    """Internal function that reads an image and shrinks it, safe to run on a thread"""
+    img = pg.image.load(path)
+    file_size = img.get_size()
+    if max_scale < 1.:
+        size = (max(1, int(file_size[0] * max_scale)), max(1, int(file_size[1] * max_scale)))
+        img = pg.transform.smoothscale(img, size)
+    return img, file_size
+
+
+def _store_image(path, img, file_size, max_scale):
+    """Internal function that converts a decoded image and counts it against the budget"""
+    global LOADED_IMAGE_BYTES
+    if pg.display.get_surface() is not None:
+        img = img.convert_alpha()
+    size = _surface_bytes(img)
+    old = LOADED_IMAGES.get(path)
+    used = LOADED_IMAGE_BYTES - (old["bytes"] if old else 0) + size
+    if used > ASSET_BUDGET:
+        raise AssetBudgetExceeded(f"Loading {path} would use {used} bytes of images, "
+                                  f"the budget is {ASSET_BUDGET}")
+    if old:
+        IMAGE_SCALES.pop(old["image"], None)
+    LOADED_IMAGES[path] = {
+        "image": img,
+        "file_size": file_size,
+        "size": img.get_size(),
+        "bytes": size,
+    }
+    LOADED_IMAGE_BYTES = used
+    if max_scale < 1.:
+        IMAGE_SCALES[img] = max_scale
+    return img
+
+
+def load_image(path, max_scale=1.):
+    """
+        Loads the image at path, converted to the pixel format of the window
+        so it's fast to draw. If the image is never drawn larger than
+        max_scale it's shrunk to that size now, with smoothing, and
+        draw_transformed still scales it as if it was the size of the file.
+    """
+    img, file_size = _decode_image(path, max_scale)
+    return _store_image(path, img, file_size, max_scale)
+
+
+def set_asset_budget(max_bytes):
+    """Sets how many bytes the images from load_image may use together."""
+    global ASSET_BUDGET
+    ASSET_BUDGET = max_bytes
+
+
+def asset_stats():
+    """Returns a dict with the memory use of every image from load_image."""
+    return {
+        "bytes": LOADED_IMAGE_BYTES,
+        "budget": ASSET_BUDGET,
+        "assets": {path: {key: value for key, value in loaded.items() if key != "image"}
+                   for path, loaded in LOADED_IMAGES.items()},
+    }
+
+
+# Missing images are replaced by a checkerboard this big, before scaling.
+MISSING_IMAGE_SIZE = (400, 400)
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tga")
+
+
+def _missing_image(max_scale):
+    """Internal function that makes a checkerboard to draw instead of a missing image"""
+    w, h = (max(1, int(side * max_scale)) for side in MISSING_IMAGE_SIZE)
+    img = pg.Surface((w, h), pg.SRCALPHA)
+    img.fill(pg.Color(255, 0, 255))
+    square = max(1, min(w, h) // 4)
+    for y in range(0, h, square):
+        for x in range((y // square) % 2 * square, w, 2 * square):
+            img.fill(pg.Color(0, 0, 0), (x, y, square, square))
+    return img, MISSING_IMAGE_SIZE
+
+
+def _decode_asset(path, max_scale):
+    """Internal function that decodes one asset of a manifest, on a worker thread"""
+    if path.lower().endswith(IMAGE_EXTENSIONS):
+        return _decode_image(path, max_scale)
+    return load_sound(path)
+
+
+class AssetHandle:
+    """
+        An asset that is loading in the background. Ask done() if it's
+        finished, value is the asset, or a placeholder if it couldn't
+        be loaded. Asking for the value before it's done waits for it.
+    """
+
+    def __init__(self, name, path, max_scale, future):
+        self.name = name
+        self.path = path
+        self.max_scale = max_scale
+        self.error = None
+        self._future = future
+        self._value = None
+
+    def done(self):
+        """Returns True when the asset is loaded, or failed to load."""
+        return self._future.done()
+
+    @property
+    def value(self):
+        if self._value is None:
+            try:
+                decoded = self._future.result()
+            except Exception as error:
+                self.error = error
+                print(f"Could not load {self.path} ({error}), using a placeholder")
+                decoded = self._fallback()
+            if isinstance(decoded, tuple):
+                # Images are converted here, it needs the window.
+                decoded = _store_image(self.path, *decoded, self.max_scale)
+            self._value = decoded
+        return self._value
+
+    def _fallback(self):
+        if self.path.lower().endswith(IMAGE_EXTENSIONS):
+            return _missing_image(self.max_scale)
+        # A very short silence.
+        return pg.mixer.Sound(buffer=bytes(64))
+
+
+class AssetLoader:
+    """
+        Loads all the assets in a manifest on a pool of threads. The
+        handles are there to look at while it's loading, and finish()
+        puts the loaded assets in the into dict.
+    """
+
+    def __init__(self, manifest, into=None, on_done=None, workers=4):
+        self.into = into
+        self.on_done = on_done
+        self.finished = False
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self.handles = {}
+        for name, entry in manifest.items():
+            path, max_scale = (entry, 1.) if isinstance(entry, str) else entry
+            future = self._pool.submit(_decode_asset, path, max_scale)
+            self.handles[name] = AssetHandle(name, path, max_scale, future)
+
+    def __getitem__(self, name):
+        return self.handles[name]
+
+    def done(self):
+        """Returns True when every asset is loaded, or failed to load."""
+        return all(handle.done() for handle in self.handles.values())
+
+    def progress(self):
+        """Returns how much, from 0 to 1, of the manifest is loaded."""
+        if not self.handles:
+            return 1.0
+        return sum(handle.done() for handle in self.handles.values()) / len(self.handles)
+
+    def finish(self):
+        """
+            Waits for everything to load, puts the assets in the into dict
+            and calls on_done. Only does it once.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        for name, handle in self.handles.items():
+            value = handle.value
+            if self.into is not None:
+                self.into[name] = value
+        self._pool.shutdown(wait=False)
+        if self.on_done is not None:
+            self.on_done()
+
+    def cancel(self):
+        """Stops loading what hasn't started loading yet."""
+        for handle in self.handles.values():
+            handle._future.cancel()
+        self._pool.shutdown(wait=False)
+
+
+# The manifest start_game shows a loading screen for.
+ASSET_LOADER = None
+
+
+def load_manifest(manifest, into=None, on_done=None, workers=4):
+    """
+        Starts loading all the assets in manifest, a dict from names to
+        paths, on workers threads. Images can be given as (path, max_scale),
+        see load_image, other files are loaded as sounds. Call this in init,
+        and start_game shows a loading screen until everything is loaded.
+        Then the assets are put in the into dict and on_done is called.
+    """
+    global ASSET_LOADER
+    ASSET_LOADER = AssetLoader(manifest, into, on_done, workers)
+    return ASSET_LOADER
+
+
+def _loading_screen():
+    """Internal function that shows how far loading has come, returns False on quit"""
+    while not ASSET_LOADER.done():
+        if any(event.type == pg.QUIT for event in pg.event.get()):
+            ASSET_LOADER.cancel()
+            return False
+        if not HEADLESS:
+            window = pg.display.get_surface()
+            w, h = window.get_size()
+            clear_screen(pg.Color(0, 0, 0))
+            pg.draw.rect(window, pg.Color(255, 255, 255),
+                         (w // 4, h // 2, int(w // 2 * ASSET_LOADER.progress()), 8))
+            window.blit(render_text("Loading"), (w // 4, h // 2 - 40))
+            pg.display.flip()
+        FRAME_CLOCK.tick(FRAMERATE)
+    ASSET_LOADER.finish()
+    return True
+
+#
+# Sound
+#
+
+# Sound effects are decoded once and shared, by path.
+SOUND_CACHE = {}
+# Effects play on this many channels of their own, when they're all
+# busy a new sound takes the place of one that matters less.
+SOUND_CHANNELS = 8
+# For each reserved channel: [channel, priority, when it started].
+_VOICES = []
+# How many of the mixer's channels are reserved for _VOICES.
+_RESERVED_CHANNELS = 0
+# Format tags in WAV files, SDL can't play floating point ones.
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# The music that is streaming right now, and music that couldn't be loaded.
+MUSIC_PLAYING = None
+MISSING_MUSIC = set()
+
+
+def _decode_float_wav(path):
+    """
+        Internal function that decodes a floating point WAV file, which
+        SDL can't, to a sound in the format of the mixer.
+    """
+    frequency, size, channels = pg.mixer.get_init()
+    if np is None or size != -16:
+        raise ValueError(f"Can't decode {path} to the mixer format")
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError(f"{path} is not a WAV file")
+    form = samples = None
+    position = 12
+    while position + 8 <= len(data):
+        chunk, length = struct.unpack_from("<4sI", data, position)
+        if chunk == b"fmt " and length >= 16:
+            form, file_channels, file_frequency, _, _, bits = \
+                struct.unpack_from("<HHIIHH", data, position + 8)
+            # WAVE_FORMAT_EXTENSIBLE keeps the real format at the start of
+            # the sub format GUID.
+            if form == WAVE_FORMAT_EXTENSIBLE and length >= 40:
+                form, = struct.unpack_from("<H", data, position + 32)
+        elif chunk == b"data":
+            samples = data[position + 8:position + 8 + length]
+        # Chunks are padded to an even length.
+        position += 8 + length + (length & 1)
+    if form is None:
+        raise ValueError(f"{path} has no format chunk")
+    if form != WAVE_FORMAT_IEEE_FLOAT or bits not in (32, 64) or file_channels == 0:
+        raise ValueError(f"{path} is not a floating point WAV file")
+    if samples is None:
+        raise ValueError(f"{path} has no sound in it")
+
+    audio = np.frombuffer(samples, f"<f{bits // 8}")
+    audio = audio[:len(audio) - len(audio) % file_channels].reshape(-1, file_channels)
+    if file_frequency != frequency:
+        at = np.arange(0, len(audio), file_frequency / frequency)
+        audio = np.stack([np.interp(at, np.arange(len(audio)), audio[:, c])
+                          for c in range(file_channels)], axis=1)
+    if file_channels != channels:
+        audio = np.repeat(audio.mean(axis=1, keepdims=True), channels, axis=1)
+    pcm = (np.clip(audio, -1, 1) * 32767).astype("<i2")
+    return pg.mixer.Sound(buffer=pcm.tobytes())
+
+
+def load_sound(path):
+    """
+        Returns the sound effect in path, decoded the first time it's
+        asked for and shared after that. Floating point WAV files are
+        turned into the mixer's format, so they use less memory too.
+    """
+    sound = SOUND_CACHE.get(path)
+    if sound is None:
+        try:
+            sound = pg.mixer.Sound(path)
+        except pg.error:
+            if not path.lower().endswith(".wav"):
+                raise
+            sound = _decode_float_wav(path)
+        SOUND_CACHE[path] = sound
+    return sound
+
+
+def set_sound_channels(count):
+    """Sets how many sound effects can play at the same time."""
+    global SOUND_CHANNELS
+    SOUND_CHANNELS = count
+    _VOICES.clear()
+
+
+def _voices():
+    """Internal function that reserves the channels for sound effects"""
+    global _RESERVED_CHANNELS
+    if len(_VOICES) != SOUND_CHANNELS:
+        _VOICES.clear()
+        # Reserved channels are never picked by Sound.play, only by us, so
+        # the mixer grows to keep the channels it had free for Sound.play.
+        unreserved = max(pg.mixer.get_num_channels() - _RESERVED_CHANNELS, 0)
+        pg.mixer.set_num_channels(unreserved + SOUND_CHANNELS)
+        pg.mixer.set_reserved(SOUND_CHANNELS)
+        _RESERVED_CHANNELS = SOUND_CHANNELS
+        _VOICES.extend([pg.mixer.Channel(i), 0, 0.0] for i in range(SOUND_CHANNELS))
+    return _VOICES
+
+
+def play_sound(sound, priority=0, volume=1.0):
+    """
+        Plays sound, a sound from load_sound or a path to one. If all the
+        channels are busy, the oldest sound with the lowest priority is
+        stopped to make room. If they all have a higher priority than
+        this sound, it isn't played. Returns the channel it plays on.
+    """
+    if HEADLESS: return None
+    if isinstance(sound, str):
+        sound = load_sound(sound)
+    voices = _voices()
+    free = [voice for voice in voices if not voice[0].get_busy()]
+    if free:
+        voice = free[0]
+    else:
+        voice = min(voices, key=lambda voice: (voice[1], voice[2]))
+        if voice[1] > priority:
+            return None
+    voice[1] = priority
+    voice[2] = perf_counter()
+    voice[0].set_volume(volume)
+    voice[0].play(sound)
+    return voice[0]
+
+
+def load_music(path):
+    """
+        Sets the music pg.mixer.music plays. Returns False, and leaves
+        the music as it was, if the file can't be opened.
+    """
+    try:
+        pg.mixer.music.load(path)
+    except (pg.error, FileNotFoundError):
+        print(f"Could not load the music {path}, playing without it")
+        return False
+    return True
+
+
+def play_music(path, loops=-1, fade_ms=0):
+    """
+        Streams the music in path, from the disk while it plays. If the
+        music is already playing it just keeps going, so it's fine to call
+        this every restart. Returns False if the music can't be played.
+    """
+    global MUSIC_PLAYING
+    if path in MISSING_MUSIC:
+        return False
+    if MUSIC_PLAYING == path and pg.mixer.music.get_busy():
+        return True
+    if not load_music(path):
+        MISSING_MUSIC.add(path)
+        return False
+    pg.mixer.music.play(loops, fade_ms=fade_ms)
+    MUSIC_PLAYING = path
+    return True
+
+
+def _quit_sound():
+    """Internal function that forgets the sounds and channels before the mixer quits"""
+    global MUSIC_PLAYING, _RESERVED_CHANNELS
+    SOUND_CACHE.clear()
+    _VOICES.clear()
+    _RESERVED_CHANNELS = 0
+    MUSIC_PLAYING = None
+
+
+def stop_music(fade_ms=0):
+    """Stops the music, fading it out over fade_ms milliseconds."""
+    global MUSIC_PLAYING
+    MUSIC_PLAYING = None
+    if fade_ms:
+        pg.mixer.music.fadeout(fade_ms)
+    else:
+        pg.mixer.music.stop()
 
 #
 # Text drawing
 #
 
-LOADED_FONTS = {}
-def draw_text(text, position, size=32, color=pg.Color(255, 255, 255), font=None):
+# Keep used fonts in memory, throwing out the one that was used the
+# longest time ago when there are too many.
+MAX_LOADED_FONTS = 100
+LOADED_FONTS = OrderedDict()
+FONT_HITS = 0
+FONT_MISSES = 0
+
+def _load_font(font, size):
+    """Internal function that finds a font, loading it if it's not in memory"""
+    global FONT_HITS, FONT_MISSES
+    key = (font, size)
+    font_obj = LOADED_FONTS.get(key)
+    if font_obj is not None:
+        FONT_HITS += 1
+        LOADED_FONTS.move_to_end(key)
+        return font_obj
+    FONT_MISSES += 1
+    while len(LOADED_FONTS) >= MAX_LOADED_FONTS:
+        LOADED_FONTS.popitem(last=False)
+    font_obj = pg.font.SysFont(font, size)
+    LOADED_FONTS[key] = font_obj
+    return font_obj
+
+
+# Most text looks the same frame after frame, so the rendered text is kept.
+TEXT_CACHE = _SurfaceCache(4 * 1024 * 1024)
+
+
+def render_text(text, size=32, color=pg.Color(255, 255, 255), font=None, antialias=True):
+    """Returns a surface with the text on it, reusing it if it was rendered before."""
+    key = (text, font, size, tuple(color), antialias)
+    rendered_text = TEXT_CACHE.get(key)
+    if rendered_text is None:
+        rendered_text = _load_font(font, size).render(text, antialias, color)
+        TEXT_CACHE.put(key, rendered_text)
+    return rendered_text
+
+
+def prewarm_text(texts, size=32, color=pg.Color(255, 255, 255), font=None, antialias=True):
+    """Renders texts ahead of time, so the first frame that draws them is fast."""
+    if HEADLESS: return
+    for text in texts:
+        render_text(text, size, color, font, antialias)
+
+
+def set_text_cache_size(max_bytes):
+    """Sets how many bytes of rendered text are kept in memory."""
+    TEXT_CACHE.resize(max_bytes)
+
+
+def text_cache_stats():
+    """Returns a dict with hits, misses and memory use of the font and text caches."""
+    lookups = FONT_HITS + FONT_MISSES
+    return {
+        "fonts": {
+            "entries": len(LOADED_FONTS),
+            "max_entries": MAX_LOADED_FONTS,
+            "hits": FONT_HITS,
+            "misses": FONT_MISSES,
+            "hit_rate": FONT_HITS / lookups if lookups else 0.0,
+        },
+        "text": TEXT_CACHE.stats(),
+    }
+
+
+def draw_text(text, position, size=32, color=pg.Color(255, 255, 255), font=None, antialias=True,
+              layer=TEXT_LAYER):
     """
         Draw text at given position.
         The position is in pixels from the top left of the window.
         Optional arguments include size, color and font.
+        In batch mode it's drawn on the given layer, above the sprites.
     """
-    global LOADED_FONTS
-
-    # Keep used fonts in memory.
-    # This is not a good solution if many different font sizes are used,
-    # but i cannot find a better way to do it...
-    if (font, size) not in LOADED_FONTS:
-        if len(LOADED_FONTS) > 100:
-            LOADED_FONTS.popitem()
-        LOADED_FONTS[(font, size)] = pg.font.SysFont(font, size)
-
-    font_obj = LOADED_FONTS[(font, size)]
-
-    rendered_text = font_obj.render(text, True, color)
+    if HEADLESS: return
+    rendered_text = render_text(text, size, color, font, antialias)
 
+    if SPRITE_BATCH is not None:
+        _batch(layer, (rendered_text, position))
+        return
     window = pg.display.get_surface()
-    window.blit(rendered_text, position)
+    _mark_dirty(window.blit(rendered_text, position))
 
 #
 # Simple physics and collision
@@ -218,11 +1279,1043 @@ def solve_rect_overlap(a, b, vel_a=(0, 0), vel_b=(0, 0), mass_a=1, mass_b=1, bou
     return vel_a, vel_b, True, normal
 
 
+def merge_tiles(tiles, tile_size):
+    """
+        Takes a collection of (x, y) tile coordinates and covers them with
+        as few pg.Rects as it easily can. Tiles next to each other on a row
+        are joined first, then rows that line up are joined downwards.
+
+        The returned rects cover exactly the same area as the tiles.
+    """
+    rows = {}
+    for tile_x, tile_y in tiles:
+        rows.setdefault(tile_y, []).append(tile_x)
+
+    # Runs of tiles on each row, as (start, end) with end exclusive.
+    runs_by_row = {}
+    for tile_y, xs in rows.items():
+        xs.sort()
+        runs = []
+        start = prev = xs[0]
+        for tile_x in xs[1:]:
+            if tile_x == prev:
+                continue
+            if tile_x != prev + 1:
+                runs.append((start, prev + 1))
+                start = tile_x
+            prev = tile_x
+        runs.append((start, prev + 1))
+        runs_by_row[tile_y] = runs
+
+    # Grow each run downwards as long as the row below has the same run.
+    rects = []
+    for tile_y in sorted(runs_by_row):
+        for run in runs_by_row[tile_y]:
+            if run is None:
+                continue
+            start, end = run
+            height = 1
+            while True:
+                below = runs_by_row.get(tile_y + height)
+                if not below or run not in below:
+                    break
+                below[below.index(run)] = None
+                height += 1
+            rects.append(pg.Rect(start * tile_size,
+                                 tile_y * tile_size,
+                                 (end - start) * tile_size,
+                                 height * tile_size))
+    return rects
+
+
+class SpatialGrid:
+    """
+        A uniform grid over static rects, for finding the rects close to
+        something without checking every single one of them.
+
+        Anything with centerx, centery, width and height can be stored and
+        queried, so pg.Rect works, as do your own classes.
+    """
+
+    def __init__(self, cell_size, rects=()):
+        self.cell_size = cell_size
+        self.rects = []
+        self._cells = {}
+        for rect in rects:
+            self.insert(rect)
+
+    def _cell_span(self, rect, margin):
+        """Internal function giving the range of cells rect touches"""
+        half_w = rect.width / 2 + margin
+        half_h = rect.height / 2 + margin
+        size = self.cell_size
+        return (math.floor((rect.centerx - half_w) / size),
+                math.floor((rect.centery - half_h) / size),
+                math.floor((rect.centerx + half_w) / size),
+                math.floor((rect.centery + half_h) / size))
+
+    def insert(self, rect):
+        """Adds a rect to the grid. The rect is not expected to move."""
+        index = len(self.rects)
+        self.rects.append(rect)
+        min_x, min_y, max_x, max_y = self._cell_span(rect, 0)
+        for cell_y in range(min_y, max_y + 1):
+            for cell_x in range(min_x, max_x + 1):
+                self._cells.setdefault((cell_x, cell_y), []).append(index)
+
+    def query(self, rect, margin=0):
+        """
+            Returns the stored rects that touch or overlap rect, grown by margin
+            on all sides. Might also return some rects that are a bit further
+            away. The rects come in the order they were inserted.
+        """
+        min_x, min_y, max_x, max_y = self._cell_span(rect, margin)
+        cells = self._cells
+        found = set()
+        for cell_y in range(min_y, max_y + 1):
+            for cell_x in range(min_x, max_x + 1):
+                indices = cells.get((cell_x, cell_y))
+                if indices:
+                    found.update(indices)
+        rects = self.rects
+        return [rects[i] for i in sorted(found)]
+
+
 def damping(vel, damp=0.1):
     """Slows down an object by damp factor per second."""
-    fac = damp ** DELTA
+    fac = damp ** delta()
     return vel[0] * fac, vel[1] * fac
 
+#
+# Allocation free physics
+# (the same as above, but without building tuples and lambdas every call)
+#
+
+class Vec2:
+    """
+        A mutable 2D vector. It can be indexed like a tuple, so it can be
+        passed to functions that expect (x, y).
+    """
+    __slots__ = ("x", "y")
+
+    def __init__(self, x=0.0, y=0.0):
+        self.x = x
+        self.y = y
+
+    @classmethod
+    def from_tuple(cls, v):
+        return cls(v[0], v[1])
+
+    def set(self, x, y):
+        self.x = x
+        self.y = y
+        return self
+
+    def __getitem__(self, i):
+        if i == 0:
+            return self.x
+        if i == 1:
+            return self.y
+        raise IndexError("Vec2 index out of range")
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        yield self.x
+        yield self.y
+
+    def __repr__(self):
+        return f"Vec2({self.x}, {self.y})"
+
+
+class AABB:
+    """
+        A mutable axis aligned box, stored as its center and size. It uses the
+        same names as pg.Rect, but keeps floats instead of rounding to pixels.
+    """
+    __slots__ = ("centerx", "centery", "width", "height")
+
+    def __init__(self, centerx=0.0, centery=0.0, width=0.0, height=0.0):
+        self.centerx = centerx
+        self.centery = centery
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def from_rect(cls, rect):
+        """Copies anything with centerx, centery, width and height, like a pg.Rect."""
+        return cls(rect.centerx, rect.centery, rect.width, rect.height)
+
+    def set(self, centerx, centery, width, height):
+        self.centerx = centerx
+        self.centery = centery
+        self.width = width
+        self.height = height
+        return self
+
+    def __repr__(self):
+        return f"AABB({self.centerx}, {self.centery}, {self.width}, {self.height})"
+
+
+# Scratch space, used when the caller doesn't care about the normal.
+_SCRATCH_NORMAL = Vec2()
+
+
+def overlap_into(a, b, normal=None):
+    """
+        The same as overlap_data, but the normal is written into the Vec2
+        normal instead of being returned.
+
+        a and b can be a pg.Rect, an AABB, or anything else with centerx,
+        centery, width and height.
+
+        returns -> depth
+    """
+    if normal is None:
+        normal = _SCRATCH_NORMAL
+    delta_x = a.centerx - b.centerx
+    delta_y = a.centery - b.centery
+    overlap_x = (a.width + b.width) / 2 - abs(delta_x)
+    overlap_y = (a.height + b.height) / 2 - abs(delta_y)
+
+    if abs(overlap_x) < abs(overlap_y):
+        normal.x = 1 if delta_x > 0 else -1
+        normal.y = 0
+    else:
+        normal.x = 0
+        normal.y = 1 if delta_y > 0 else -1
+
+    return overlap_x if overlap_x < overlap_y else overlap_y
+
+
+def solve_overlap_into(a, b, vel_a, vel_b=None, mass_a=1, mass_b=1, bounce=1, normal=None):
+    """
+        The same as solve_rect_overlap, but the velocities are Vec2s that are
+        changed in place, and the normal is written into the Vec2 normal.
+        Leave vel_b as None if b isn't moving.
+
+        returns -> True if a and b overlapped
+    """
+    if normal is None:
+        normal = _SCRATCH_NORMAL
+    depth = overlap_into(a, b, normal)
+    if depth < 0: return False
+    normal_x = normal.x
+    normal_y = normal.y
+
+    # Positional correction
+    total_mass = mass_a + mass_b
+    if total_mass != 0:
+        effect_a = mass_a / total_mass
+        a.centerx = a.centerx + normal_x * depth * effect_a
+        a.centery = a.centery + normal_y * depth * effect_a
+
+        if mass_b:
+            effect_b = mass_b / total_mass
+            b.centerx = b.centerx - normal_x * depth * effect_b
+            b.centery = b.centery - normal_y * depth * effect_b
+
+    # Velocity correction
+    relative_v = vel_a.x * normal_x + vel_a.y * normal_y
+    if vel_b is not None:
+        relative_v -= vel_b.x * normal_x + vel_b.y * normal_y
+    relative_v *= 1 + bounce
+    if total_mass != 0 and relative_v < 0:
+        push_a = -relative_v * mass_a / total_mass
+        vel_a.x += normal_x * push_a
+        vel_a.y += normal_y * push_a
+        if vel_b is not None:
+            push_b = relative_v * mass_b / total_mass
+            vel_b.x += normal_x * push_b
+            vel_b.y += normal_y * push_b
+
+    return True
+
+
+# Scratch space for the normal of each rect in move_swept.
+_SWEEP_NORMAL = Vec2()
+
+def sweep_into(a, move_x, move_y, b, normal=None):
+    """
+        Finds when a, moving by (move_x, move_y), first touches b, which
+        stays still. Rects that already overlap hit right away if a moves
+        further in along the axis it would be pushed out on, so it can't
+        be pushed out the other side. Otherwise they are left to
+        solve_overlap_into.
+
+        The normal is written into the Vec2 normal, pointing from b.
+
+        returns -> the time of impact from 0 to 1, or None if they don't meet
+    """
+    if normal is None:
+        normal = _SCRATCH_NORMAL
+    reach_x = (a.width + b.width) / 2
+    reach_y = (a.height + b.height) / 2
+    delta_x = b.centerx - a.centerx
+    delta_y = b.centery - a.centery
+
+    depth_x = reach_x - abs(delta_x)
+    depth_y = reach_y - abs(delta_y)
+    if depth_x > 0 and depth_y > 0:
+        # Already overlapping, only moving deeper in counts.
+        if depth_x < depth_y:
+            if move_x * delta_x <= 0: return None
+            normal.x = -1 if delta_x > 0 else 1
+            normal.y = 0
+        else:
+            if move_y * delta_y <= 0: return None
+            normal.x = 0
+            normal.y = -1 if delta_y > 0 else 1
+        return 0.0
+
+    # When a is inside b along each axis, as a fraction of the move.
+    if move_x == 0:
+        if abs(delta_x) >= reach_x: return None
+        entry_x, exit_x = -math.inf, math.inf
+    else:
+        entry_x = (delta_x - math.copysign(reach_x, move_x)) / move_x
+        exit_x = (delta_x + math.copysign(reach_x, move_x)) / move_x
+
+    if move_y == 0:
+        if abs(delta_y) >= reach_y: return None
+        entry_y, exit_y = -math.inf, math.inf
+    else:
+        entry_y = (delta_y - math.copysign(reach_y, move_y)) / move_y
+        exit_y = (delta_y + math.copysign(reach_y, move_y)) / move_y
+
+    entry = max(entry_x, entry_y)
+    if entry >= min(exit_x, exit_y) or entry < 0 or entry > 1:
+        return None
+
+    if entry_x > entry_y:
+        normal.x = -1 if move_x > 0 else 1
+        normal.y = 0
+    else:
+        normal.x = 0
+        normal.y = -1 if move_y > 0 else 1
+    return entry
+
+
+def swept_bounds(a, move_x, move_y, out=None):
+    """The AABB covering all of a while it moves by (move_x, move_y)."""
+    if out is None:
+        out = AABB()
+    return out.set(a.centerx + move_x / 2, a.centery + move_y / 2,
+                   a.width + abs(move_x), a.height + abs(move_y))
+
+
+def move_swept(a, velocity, delta, statics, bounce=0, max_hits=4, normal=None):
+    """
+        Moves a by velocity * delta, but stops at the first static rect it
+        would run into instead of going through it, and slides along it for
+        the rest of the step. Fast things don't tunnel through thin walls
+        this way, however long the step is.
+
+        velocity - a Vec2, the part of it going into what a hits is taken
+                   away, and bounced back by bounce.
+        statics  - the rects that might be in the way, for example what a
+                   SpatialGrid gives for swept_bounds(a, move_x, move_y).
+        max_hits - how many times a can hit something in one step, the
+                   rest of the move is dropped after that.
+
+        returns -> True if a hit something
+    """
+    if normal is None:
+        normal = _SCRATCH_NORMAL
+    time_left = delta
+    hit = False
+    for _ in range(max_hits):
+        move_x = velocity.x * time_left
+        move_y = velocity.y * time_left
+        first = None
+        for b in statics:
+            t = sweep_into(a, move_x, move_y, b, _SWEEP_NORMAL)
+            if t is not None and (first is None or t < first):
+                first = t
+                normal.set(_SWEEP_NORMAL.x, _SWEEP_NORMAL.y)
+        if first is None:
+            a.centerx += move_x
+            a.centery += move_y
+            return hit
+
+        hit = True
+        a.centerx += move_x * first
+        a.centery += move_y * first
+        into = velocity.x * normal.x + velocity.y * normal.y
+        if into < 0:
+            velocity.x -= (1 + bounce) * into * normal.x
+            velocity.y -= (1 + bounce) * into * normal.y
+        time_left *= 1 - first
+    return hit
+
+
+#
+# Batched physics
+# (needs numpy, these work on many rects at once)
+#
+
+def _require_numpy():
+    """Internal function that complains if numpy is missing"""
+    if np is None:
+        raise ImportError("The batched physics functions need numpy, "
+                          "install it with 'pip install numpy'")
+
+
+def rect_array(rects):
+    """
+        Packs rects into a float array with one row per rect, laid out as
+        (centerx, centery, width, height). Anything with those attributes
+        works, like a pg.Rect or your own player class.
+    """
+    _require_numpy()
+    out = np.empty((len(rects), 4), dtype=np.float64)
+    for i, rect in enumerate(rects):
+        out[i] = (rect.centerx, rect.centery, rect.width, rect.height)
+    return out
+
+
+def overlap_data_batch(a, b):
+    """
+        Like overlap_data, but for every pair of rects in a and b at once.
+        a is (N, 4) and b is (M, 4), both laid out like rect_array.
+
+        returns -> normals (N, M, 2), depths (N, M)
+        (normals point from a)
+    """
+    _require_numpy()
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    delta_x = a[:, None, 0] - b[None, :, 0]
+    delta_y = a[:, None, 1] - b[None, :, 1]
+    overlap_x = (a[:, None, 2] + b[None, :, 2]) / 2 - np.abs(delta_x)
+    overlap_y = (a[:, None, 3] + b[None, :, 3]) / 2 - np.abs(delta_y)
+    depths = np.minimum(overlap_x, overlap_y)
+
+    along_x = np.abs(overlap_x) < np.abs(overlap_y)
+    normals = np.zeros(depths.shape + (2,), dtype=np.float64)
+    normals[..., 0] = np.where(along_x, np.where(delta_x > 0, 1, -1), 0)
+    normals[..., 1] = np.where(along_x, 0, np.where(delta_y > 0, 1, -1))
+    return normals, depths
+
+
+def rect_overlap_corrections(rects, vels, statics, mass=1, bounce=1):
+    """
+        Solves every pair of moving and static rects on its own, like calling
+        solve_rect_overlap(rect, static, vel, mass_a=mass, mass_b=0, bounce=bounce)
+        on fresh copies for each pair.
+
+        rects  - (N, 4) moving rects, laid out like rect_array.
+        vels   - (N, 2) velocities of the moving rects.
+        statics - (M, 4) static rects, these never move.
+        mass   - mass of the moving rects, a number or one per rect.
+
+        returns -> hits (N, M), normals (N, M, 2), depths (N, M),
+                   position corrections (N, M, 2), velocity corrections (N, M, 2)
+    """
+    _require_numpy()
+    vels = np.asarray(vels, dtype=np.float64).reshape(-1, 2)
+    normals, depths = overlap_data_batch(rects, statics)
+    hits = depths >= 0
+
+    # A static rect has no mass, so the moving rect takes all the correction,
+    # unless it has no mass either.
+    movable = np.broadcast_to(np.asarray(mass, dtype=np.float64), (len(vels),)) != 0
+    solved = hits & movable[:, None]
+
+    position = normals * np.where(solved, depths, 0)[..., None]
+
+    relative_v = (1 + bounce) * (vels[:, None, 0] * normals[..., 0] +
+                                 vels[:, None, 1] * normals[..., 1])
+    push = np.where(solved & (relative_v < 0), -relative_v, 0)
+    velocity = normals * push[..., None]
+    return hits, normals, depths, position, velocity
+
+
+def solve_rect_overlap_batch(rects, vels, statics, mass=1, bounce=1):
+    """
+        Moves many rects out of many static rects, the same way as calling
+        solve_rect_overlap(rect, static, vel, mass_a=mass, mass_b=0, bounce=bounce)
+        for each static rect in order, for every moving rect.
+
+        The static rects are looped over in Python, the moving rects are
+        all handled at the same time, so this pays off with lots of movers.
+
+        returns -> rects (N, 4), velocities (N, 2), hits (N, M), normals (N, M, 2)
+    """
+    _require_numpy()
+    rects = np.array(rects, dtype=np.float64).reshape(-1, 4)
+    vels = np.array(vels, dtype=np.float64).reshape(-1, 2)
+    statics = np.asarray(statics, dtype=np.float64).reshape(-1, 4)
+    movable = np.broadcast_to(np.asarray(mass, dtype=np.float64), (len(rects),)) != 0
+
+    hits = np.zeros((len(rects), len(statics)), dtype=bool)
+    normals = np.zeros((len(rects), len(statics), 2), dtype=np.float64)
+    for j, static in enumerate(statics):
+        step_normals, step_depths = overlap_data_batch(rects, static[None, :])
+        normal = step_normals[:, 0]
+        depth = step_depths[:, 0]
+        hit = depth >= 0
+        hits[:, j] = hit
+        normals[:, j] = normal
+
+        solved = hit & movable
+        rects[:, :2] += normal * np.where(solved, depth, 0)[:, None]
+
+        relative_v = (1 + bounce) * (vels[:, 0] * normal[:, 0] +
+                                     vels[:, 1] * normal[:, 1])
+        push = np.where(solved & (relative_v < 0), -relative_v, 0)
+        vels += normal * push[:, None]
+    return rects, vels, hits, normals
+
+
+def solve_rect_overlap_pairs(rects, vels, statics, mass=1, bounce=1, pairs=None):
+    """
+        Moves every rect out of the static rect on the same row of statics,
+        the same way as solve_rect_overlap(rect, static, vel, mass_a=mass,
+        mass_b=0, bounce=bounce) for each of them.
+
+        rects   - (N, 4) moving rects, laid out like rect_array, moved in place.
+        vels    - (N, 2) velocities of the moving rects, changed in place.
+        statics - (N, 4) one static rect for each moving rect.
+        pairs   - (N,) bools, only the pairs that are True are solved.
+
+        returns -> hits (N,)
+    """
+    _require_numpy()
+    delta = rects[:, :2] - statics[:, :2]
+    overlap = (rects[:, 2:] + statics[:, 2:]) / 2 - np.abs(delta)
+    depth = np.minimum(overlap[:, 0], overlap[:, 1])
+    hits = depth >= 0
+    if pairs is not None:
+        hits &= pairs
+    solved = hits & (np.broadcast_to(np.asarray(mass, dtype=np.float64), hits.shape) != 0)
+    if not solved.any():
+        return hits
+
+    along_x = np.abs(overlap[:, 0]) < np.abs(overlap[:, 1])
+    normal = np.zeros_like(delta)
+    normal[:, 0] = np.where(along_x, np.where(delta[:, 0] > 0, 1, -1), 0)
+    normal[:, 1] = np.where(along_x, 0, np.where(delta[:, 1] > 0, 1, -1))
+
+    rects[:, :2] += normal * np.where(solved, depth, 0)[:, None]
+
+    relative_v = (vels[:, 0] * normal[:, 0] + vels[:, 1] * normal[:, 1]) * (1 + bounce)
+    push = np.where(solved & (relative_v < 0), -relative_v, 0)
+    vels += normal * push[:, None]
+    return hits
+
+
+class SweepAndPrune:
+    """
+        A broadphase for lots of moving rects. Finds the pairs of rects that
+        overlap or touch by sorting them along x and sweeping over them, so
+        it doesn't have to check every pair.
+
+        The order from the last call is kept and sorted again, which is
+        quick since things only move a little between frames.
+
+        Every rect can have a category, one bit, and a mask of the
+        categories it cares about. A pair is only found if both rects are
+        in the mask of the other.
+    """
+
+    def __init__(self):
+        self._order = None
+
+    def pairs(self, rects, categories=None, masks=None):
+        """
+            rects      - (N, 4) array, laid out like rect_array.
+            categories - (N,) ints, a rect with category 0 is never in a pair.
+            masks      - (N,) ints, everything if left out.
+
+            returns -> first (K,), second (K,)
+            (indices into rects, first is always less than second)
+        """
+        _require_numpy()
+        rects = np.asarray(rects, dtype=np.float64)
+        count = len(rects)
+        half_w = rects[:, 2] / 2
+        min_x = rects[:, 0] - half_w
+        max_x = rects[:, 0] + half_w
+
+        if self._order is None or len(self._order) != count:
+            self._order = np.argsort(min_x, kind="stable")
+        else:
+            # Almost sorted already, which the stable sort is fast at.
+            self._order = self._order[np.argsort(min_x[self._order], kind="stable")]
+        order = self._order
+
+        # Every rect starting before the one at i in the order ends, and
+        # after it in the order, overlaps it along x.
+        ends = np.searchsorted(min_x[order], max_x[order], side="right")
+        counts = np.maximum(ends - np.arange(1, count + 1), 0)
+        first = np.repeat(np.arange(count), counts)
+        second = np.arange(1, len(first) + 1) + np.repeat(np.arange(count) - np.cumsum(counts) + counts, counts)
+
+        center_y = rects[order, 1]
+        half_h = rects[order, 3] / 2
+        keep = np.abs(center_y[first] - center_y[second]) <= half_h[first] + half_h[second]
+        first = order[first[keep]]
+        second = order[second[keep]]
+
+        if categories is not None:
+            categories = np.asarray(categories)
+            masks = np.full(count, -1) if masks is None else np.asarray(masks)
+            keep = (((categories[first] & masks[second]) != 0) &
+                    ((categories[second] & masks[first]) != 0))
+            first = first[keep]
+            second = second[keep]
+        return np.minimum(first, second), np.maximum(first, second)
+
+
+#
+# Entity storage
+#
+
+class EntityView:
+    """
+        One entity in an EntityStore. Reads and writes go straight to the
+        arrays of the store, so it can be used like any other object with
+        centerx, centery, width, height, velocity and face_left.
+    """
+    __slots__ = ("store", "index")
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    @property
+    def centerx(self):
+        return float(self.store._position[self.index, 0])
+
+    @centerx.setter
+    def centerx(self, value):
+        self.store._position[self.index, 0] = value
+
+    @property
+    def centery(self):
+        return float(self.store._position[self.index, 1])
+
+    @centery.setter
+    def centery(self, value):
+        self.store._position[self.index, 1] = value
+
+    @property
+    def last_centerx(self):
+        return float(self.store._last_position[self.index, 0])
+
+    @last_centerx.setter
+    def last_centerx(self, value):
+        self.store._last_position[self.index, 0] = value
+
+    @property
+    def last_centery(self):
+        return float(self.store._last_position[self.index, 1])
+
+    @last_centery.setter
+    def last_centery(self, value):
+        self.store._last_position[self.index, 1] = value
+
+    @property
+    def width(self):
+        return float(self.store._size[self.index, 0])
+
+    @property
+    def height(self):
+        return float(self.store._size[self.index, 1])
+
+    @property
+    def velocity(self):
+        velocity = self.store._velocity[self.index]
+        return (float(velocity[0]), float(velocity[1]))
+
+    @velocity.setter
+    def velocity(self, value):
+        self.store._velocity[self.index] = value
+
+    @property
+    def face_left(self):
+        return bool(self.store._face_left[self.index])
+
+    @face_left.setter
+    def face_left(self, value):
+        self.store._face_left[self.index] = value
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.centerx}, {self.centery})"
+
+
+class EntityStore:
+    """
+        Keeps lots of entities in numpy arrays, one row per entity, so they
+        can all be updated at once:
+
+            position, last_position, velocity, size - (N, 2) float arrays
+            face_left - (N,) bool array
+
+        Iterating over the store, or indexing it, gives a view of one
+        entity for when you only care about one at a time. view is the
+        class of those views, a subclass of EntityView.
+    """
+
+    def __init__(self, view=EntityView, capacity=16):
+        _require_numpy()
+        self.view = view
+        self.count = 0
+        self._views = []
+        self._position = np.zeros((capacity, 2))
+        self._last_position = np.zeros((capacity, 2))
+        self._velocity = np.zeros((capacity, 2))
+        self._size = np.zeros((capacity, 2))
+        self._face_left = np.zeros(capacity, dtype=bool)
+
+    def _grow(self):
+        """Internal function that doubles the room for entities"""
+        for name in ("_position", "_last_position", "_velocity", "_size", "_face_left"):
+            old = getattr(self, name)
+            new = np.zeros((len(old) * 2,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def add(self, centerx, centery, width, height, velocity=(0, 0), face_left=False):
+        """Adds an entity and returns the view of it."""
+        if self.count == len(self._position):
+            self._grow()
+        i = self.count
+        self._position[i] = (centerx, centery)
+        self._last_position[i] = (centerx, centery)
+        self._velocity[i] = velocity
+        self._size[i] = (width, height)
+        self._face_left[i] = face_left
+        self.count += 1
+        entity = self.view(self, i)
+        self._views.append(entity)
+        return entity
+
+    @property
+    def position(self):
+        return self._position[:self.count]
+
+    @property
+    def last_position(self):
+        return self._last_position[:self.count]
+
+    @property
+    def velocity(self):
+        return self._velocity[:self.count]
+
+    @property
+    def size(self):
+        return self._size[:self.count]
+
+    @property
+    def face_left(self):
+        return self._face_left[:self.count]
+
+    def rects(self):
+        """The entities as an (N, 4) array, laid out like rect_array."""
+        return np.hstack((self.position, self.size))
+
+    def remember_positions(self):
+        """Copies every position into last_position, for smooth drawing."""
+        self.last_position[:] = self.position
+
+    def state(self):
+        """A copy of everything that changes, to give to set_state later."""
+        return (self.position.copy(), self.last_position.copy(),
+                self.velocity.copy(), self.face_left.copy())
+
+    def set_state(self, state):
+        position, last_position, velocity, face_left = state
+        self.position[:] = position
+        self.last_position[:] = last_position
+        self.velocity[:] = velocity
+        self.face_left[:] = face_left
+
+    def state_size(self):
+        """How many bytes state_into writes."""
+        return self.count * (6 * 8 + 1)
+
+    def state_into(self, buffer, offset):
+        """
+            Writes everything that changes into buffer at offset, for
+            snapshots. It's copied straight in, nothing new is made.
+        """
+        n = self.count
+        if not n:
+            return
+        floats = np.ndarray((3, n, 2), np.float64, buffer, offset)
+        floats[0] = self.position
+        floats[1] = self.last_position
+        floats[2] = self.velocity
+        np.ndarray(n, bool, buffer, offset + 6 * 8 * n)[:] = self.face_left
+
+    def set_state_from(self, buffer, offset):
+        """Reads back what state_into wrote at offset."""
+        n = self.count
+        if not n:
+            return
+        floats = np.ndarray((3, n, 2), np.float64, buffer, offset)
+        self.position[:] = floats[0]
+        self.last_position[:] = floats[1]
+        self.velocity[:] = floats[2]
+        self.face_left[:] = np.ndarray(n, bool, buffer, offset + 6 * 8 * n)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self._views)
+
+    def __getitem__(self, index):
+        return self._views[index]
+
+
+#
+# Snapshots
+#
+
+class SnapshotRing:
+    """
+        Keeps the last few snapshots of some state, packed with a
+        struct.Struct layout into one buffer that is made up front. Pushing
+        a snapshot writes over the oldest one once the buffer is full.
+
+        What goes into a snapshot is up to you, layout.pack_into gets the
+        values you push and get() gives them back as a tuple. Each snapshot
+        also has extra_size bytes after the values, for things like arrays
+        that are better written straight into buffer at extra_offset().
+    """
+
+    def __init__(self, layout, frames, extra_size=0):
+        self.layout = layout
+        self.frames = frames
+        self.extra_size = extra_size
+        self.slot_size = layout.size + extra_size
+        self.buffer = bytearray(self.slot_size * frames)
+        self.count = 0
+        self._latest = -1
+
+    def __len__(self):
+        return self.count
+
+    def push(self, *values):
+        """
+            Stores a new snapshot, forgetting the oldest one if it's full.
+
+            returns -> where in buffer the extra bytes of the snapshot go
+        """
+        self._latest = (self._latest + 1) % self.frames
+        self.layout.pack_into(self.buffer, self._latest * self.slot_size, *values)
+        if self.count < self.frames:
+            self.count += 1
+        return self._latest * self.slot_size + self.layout.size
+
+    def extra_offset(self, frames_ago=0):
+        """Where in buffer the extra bytes of the snapshot frames_ago are."""
+        if not 0 <= frames_ago < self.count:
+            raise IndexError(f"Only {self.count} snapshots stored, not {frames_ago + 1}")
+        slot = (self._latest - frames_ago) % self.frames
+        return slot * self.slot_size + self.layout.size
+
+    def get(self, frames_ago=0):
+        """The values of the snapshot pushed frames_ago pushes before the latest."""
+        if not 0 <= frames_ago < self.count:
+            raise IndexError(f"Only {self.count} snapshots stored, not {frames_ago + 1}")
+        slot = (self._latest - frames_ago) % self.frames
+        return self.layout.unpack_from(self.buffer, slot * self.slot_size)
+
+    def rewind(self, frames_ago=0):
+        """
+            Like get, but also forgets the snapshots newer than that one,
+            so the next push continues from there.
+        """
+        values = self.get(frames_ago)
+        self._latest = (self._latest - frames_ago) % self.frames
+        self.count -= frames_ago
+        return values
+
+    def pop(self):
+        """Returns the latest snapshot and forgets it."""
+        values = self.get()
+        self._latest = (self._latest - 1) % self.frames
+        self.count -= 1
+        return values
+
+    def clear(self):
+        self.count = 0
+        self._latest = -1
+
+    def relayout(self, layout, extra_size=0):
+        """
+            Forgets the snapshots and makes room for ones with another
+            layout, keeping the buffer if they take up as many bytes.
+        """
+        self.layout = layout
+        self.extra_size = extra_size
+        if layout.size + extra_size != self.slot_size:
+            self.slot_size = layout.size + extra_size
+            self.buffer = bytearray(self.slot_size * self.frames)
+        self.clear()
+
+
+#
+# Performance measuring
+#
+
+# How many frames of timings are kept around.
+PERF_HISTORY = 300
+PERF_OVERLAY = False
+PERF_OVERLAY_KEY = pg.K_F3
+
+FRAME_TIMES = deque(maxlen=PERF_HISTORY)
+PHASE_TIMES = {}
+_PHASES_THIS_FRAME = {}
+
+
+@contextmanager
+def perf_scope(name):
+    """
+        Measures the time spent inside a with block, adding it to the phase
+        called name for this frame. Scopes can be nested.
+    """
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        _PHASES_THIS_FRAME[name] = _PHASES_THIS_FRAME.get(name, 0.0) + elapsed
+        if TRACE_EVENTS is not None:
+            TRACE_EVENTS.append((name, start, elapsed))
+
+
+def _end_perf_frame(frame_time):
+    """Internal function that stores the timings of the frame that just ended"""
+    FRAME_TIMES.append(frame_time)
+    for name in _PHASES_THIS_FRAME:
+        if name not in PHASE_TIMES:
+            PHASE_TIMES[name] = deque(maxlen=PERF_HISTORY)
+    for name, times in PHASE_TIMES.items():
+        times.append(_PHASES_THIS_FRAME.get(name, 0.0))
+    _PHASES_THIS_FRAME.clear()
+
+
+def _summarize_times(times):
+    """Internal function giving the mean and percentiles of some timings"""
+    if not times:
+        return {"mean": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(times)
+    last = len(ordered) - 1
+    return {
+        "mean": sum(ordered) / len(ordered),
+        "p50": ordered[round(last * 0.50)],
+        "p95": ordered[round(last * 0.95)],
+        "p99": ordered[round(last * 0.99)],
+        "max": ordered[last],
+    }
+
+
+def perf_stats():
+    """
+        Returns the timings of the last PERF_HISTORY frames, in seconds,
+        for whole frames and for every phase.
+    """
+    return {
+        "frame": _summarize_times(FRAME_TIMES),
+        "phases": {name: _summarize_times(times) for name, times in PHASE_TIMES.items()},
+    }
+
+
+# Tracing keeps the latest events, each one is (name, start, duration).
+# Old events are thrown away, so a long session can't run out of memory.
+TRACE_EVENTS = None
+TRACE_PATH = None
+TRACE_START = 0.0
+
+def start_trace(path, max_events=200000):
+    """
+        Starts recording every frame, phase and perf_scope. The latest
+        max_events are written to path by stop_trace, or when the game quits.
+        Open the file in chrome://tracing or https://ui.perfetto.dev
+    """
+    global TRACE_EVENTS, TRACE_PATH, TRACE_START
+    TRACE_EVENTS = deque(maxlen=max_events)
+    TRACE_PATH = path
+    TRACE_START = perf_counter()
+
+
+def stop_trace():
+    """Stops tracing and writes the events as Chrome trace event JSON."""
+    global TRACE_EVENTS
+    if TRACE_EVENTS is None:
+        return
+    events = [{
+        # Complete events, a begin and an end in one.
+        "name": name,
+        "ph": "X",
+        "ts": (start - TRACE_START) * 1e6,
+        "dur": duration * 1e6,
+        "pid": 1,
+        "tid": 1,
+    } for name, start, duration in TRACE_EVENTS]
+    with open(TRACE_PATH, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    TRACE_EVENTS = None
+
+
+# cProfile runs for the frames from PROFILE_FIRST up to PROFILE_LAST.
+PROFILER = None
+PROFILE_FIRST = 0
+PROFILE_LAST = 0
+PROFILE_PATH = None
+
+def profile_frames(first, last, path="ribs.prof"):
+    """
+        Runs cProfile from frame first up to frame last, and writes the stats
+        to path. Look at them with 'python -m pstats ribs.prof' or snakeviz.
+    """
+    global PROFILER, PROFILE_FIRST, PROFILE_LAST, PROFILE_PATH
+    PROFILER = cProfile.Profile()
+    PROFILE_FIRST = first
+    PROFILE_LAST = last
+    PROFILE_PATH = path
+
+
+def _profile_frame(frame):
+    """Internal function that starts and stops the profiler at the right frames"""
+    global PROFILER
+    if PROFILER is None:
+        return
+    if frame == PROFILE_FIRST:
+        PROFILER.enable()
+    elif frame >= PROFILE_LAST:
+        PROFILER.disable()
+        PROFILER.dump_stats(PROFILE_PATH)
+        PROFILER = None
+
+
+def set_perf_overlay(show):
+    """Shows or hides the frame timings on top of the game, F3 toggles it too."""
+    global PERF_OVERLAY
+    PERF_OVERLAY = show
+
+
+def _draw_perf_overlay(phases_shown=5):
+    """Internal function that draws the frame timings"""
+    stats = perf_stats()
+    frame = stats["frame"]
+    lines = [f"frame  p50 {frame['p50'] * 1000:5.2f}  p95 {frame['p95'] * 1000:5.2f}"
+             f"  p99 {frame['p99'] * 1000:5.2f} ms"]
+    working = [item for item in stats["phases"].items() if item[0] != "wait"]
+    slowest = sorted(working, key=lambda item: -item[1]["mean"])
+    for name, phase in slowest[:phases_shown]:
+        lines.append(f"{name:12} {phase['mean'] * 1000:5.2f} ms")
+
+    x = pg.display.get_surface().get_width() - 300
+    for i, line in enumerate(lines):
+        draw_text(line, (x, 4 + i * 18), size=20, color=pg.Color(255, 255, 0))
+
 #
 # Main loop
 # (with global state needed for code to work)
@@ -237,6 +2330,21 @@ DELTA = 1 / FRAMERATE
 TIME = 0
 FRAME_CLOCK = pg.time.Clock()
 
+# With a simulation rate set, the game logic runs at that fixed rate
+# no matter how fast frames are drawn. 0 means once per drawn frame.
+SIMULATION_RATE = 0
+MAX_SIMULATION_STEPS = 5
+ACCUMULATOR = 0
+SIMULATING = True
+RENDERING = True
+ALPHA = 1.0
+
+# Headless runs without a window or sound, and as fast as possible.
+HEADLESS = False
+# Quit after this many frames, 0 means run until the game quits.
+FRAME_LIMIT = 0
+FRAME = 0
+
 PYGAME_INITALIZED = False
 
 SCREEN_WIDTH = 500
@@ -250,6 +2358,7 @@ def set_screen_size(width, height):
     SCREEN_HEIGHT = height
     if PYGAME_INITALIZED:
         pg.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+        _redraw_all()
 
 
 def set_frame_rate(fps):
@@ -259,6 +2368,38 @@ def set_frame_rate(fps):
     DELTA = 1 / FRAMERATE
 
 
+def set_simulation_rate(rate, max_steps=5):
+    """
+        Runs the game logic at a fixed rate of steps per second, independent
+        of the frame rate. At most max_steps are run per drawn frame, if the
+        game falls further behind than that it slows down instead.
+        A rate of 0 goes back to one step per drawn frame.
+    """
+    global SIMULATION_RATE, MAX_SIMULATION_STEPS, ACCUMULATOR, ALPHA
+    SIMULATION_RATE = rate
+    MAX_SIMULATION_STEPS = max_steps
+    ACCUMULATOR = 0
+    ALPHA = 1.0
+
+
+def simulating():
+    """Return True if the game logic should run this step."""
+    return SIMULATING
+
+
+def rendering():
+    """Return True if the game should be drawn this step."""
+    return RENDERING
+
+
+def alpha():
+    """
+        Return how far, from 0 to 1, the drawn frame is between the previous
+        simulation step and the latest one. Always 1 without a simulation rate.
+    """
+    return ALPHA
+
+
 def time():
     """Return the time since the program started."""
     return TIME
@@ -266,6 +2407,8 @@ def time():
 
 def delta():
     """Return the time passed from the previous frame to this frame."""
+    if SIMULATION_RATE:
+        return 1 / SIMULATION_RATE
     if FRAMERATE:
         return DELTA
     # I know this looks wierd, but "get_time" returns the "delta",
@@ -280,8 +2423,116 @@ def restart():
     TIME = 0
 
 
-def start_game(init, update):
-    """The program starts here"""
+def _advance(simulate, render):
+    """Internal function that runs the update function once"""
+    global SIMULATING, RENDERING
+    SIMULATING = simulate
+    RENDERING = render
+    with perf_scope("update" if simulate else "draw"):
+        try:
+            next(UPDATE_ITER)
+        except StopIteration:
+            return False
+    return True
+
+
+def _events():
+    """Internal function that reads the input, and times it"""
+    with perf_scope("events"):
+        return process_events()
+
+
+def _tick(framerate=0):
+    """Internal function that waits for the next frame, and times it"""
+    with perf_scope("wait"):
+        FRAME_CLOCK.tick(framerate)
+
+
+def _run_frame():
+    """Internal function that runs one drawn frame, returns False on quit"""
+    global TIME, ACCUMULATOR, ALPHA, FRAME
+
+    if FRAME_LIMIT and FRAME >= FRAME_LIMIT:
+        return False
+    FRAME += 1
+
+    if HEADLESS:
+        # Nothing is drawn, and there's no reason to wait for the clock.
+        if not _events():
+            return False
+        _tick()
+        TIME += delta()
+        return _advance(True, False)
+
+    if not SIMULATION_RATE:
+        # See what buttons are pressed this frame.
+        if not _events():
+            return False
+        # Tell Pygame we're on a new frame, with the given framerate
+        # set it to zero to unlimit.
+        _tick(FRAMERATE)
+        TIME += DELTA
+        return _advance(True, True)
+
+    _tick(FRAMERATE)
+    step = 1 / SIMULATION_RATE
+    ACCUMULATOR += FRAME_CLOCK.get_time() / 1000.0
+
+    # Catch up with the clock, one fixed step at a time.
+    steps = 0
+    while ACCUMULATOR >= step and steps < MAX_SIMULATION_STEPS:
+        if not _events():
+            return False
+        TIME += step
+        if not _advance(True, False):
+            return False
+        ACCUMULATOR -= step
+        steps += 1
+    if ACCUMULATOR >= step:
+        # Too far behind, give up on the time we couldn't simulate.
+        ACCUMULATOR = step * 0.999
+    if not steps:
+        # Keep the window responsive even if no step ran.
+        pg.event.pump()
+
+    ALPHA = ACCUMULATOR / step
+    return _advance(False, True)
+
+
+def _env_flag(name):
+    """Internal function that reads an on/off environment variable"""
+    return os.environ.get(name, "").lower() not in ("", "0", "false", "no")
+
+
+def start_game(init, update, headless=None, input_source=None):
+    """
+        The program starts here
+
+        headless - runs without a window or sound, as fast as possible.
+                   Defaults to the RIBS_HEADLESS environment variable.
+        input_source - where to read held buttons from, see ScriptedInput.
+
+        RIBS_RECORD=file records the input to file, and RIBS_REPLAY=file
+        plays it back. RIBS_TRACE=file writes a Chrome trace of the frames,
+        and RIBS_PROFILE=first:last runs cProfile over those frames,
+        saving to RIBS_PROFILE_OUT (ribs.prof by default).
+        RIBS_SIMULATION_RATE=steps overrides set_simulation_rate.
+    """
+    global HEADLESS, FRAME_LIMIT, FRAME
+    if headless is None:
+        headless = _env_flag("RIBS_HEADLESS")
+    HEADLESS = headless
+    if HEADLESS:
+        # These have to be set before pygame starts.
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+    FRAME_LIMIT = int(os.environ.get("RIBS_FRAMES") or 0)
+    FRAME = 0
+    if os.environ.get("RIBS_SIMULATION_RATE"):
+        set_simulation_rate(float(os.environ["RIBS_SIMULATION_RATE"]), MAX_SIMULATION_STEPS)
+    if input_source is not None:
+        set_input_source(input_source)
+
     pg.init()
     pg.display.init()
     pg.mixer.init()
@@ -292,34 +2543,70 @@ def start_game(init, update):
     global FRAME_CLOCK
     FRAME_CLOCK = pg.time.Clock()
 
+    # Sets the screen resolution. The window has to be there before init,
+    # images can't be converted to its pixel format otherwise.
+    set_screen_size(SCREEN_WIDTH, SCREEN_HEIGHT)
+
     # Let you do initalization
     init()
+    # Wait for the assets init started loading, if there are any.
+    running = ASSET_LOADER is None or ASSET_LOADER.finished or _loading_screen()
 
-    # Sets the screen resolution.
-    set_screen_size(SCREEN_WIDTH, SCREEN_HEIGHT)
+    if os.environ.get("RIBS_REPLAY"):
+        set_input_source(InputReplay(os.environ["RIBS_REPLAY"]))
+    if os.environ.get("RIBS_RECORD"):
+        set_input_source(InputRecorder(os.environ["RIBS_RECORD"], INPUT_SOURCE))
 
     global UPDATE_FUNC, TIME
     UPDATE_FUNC = update
     # First start is a restart.
     restart()
 
-    # See what buttons are pressed this frame, and continue if we haven't quit.
-    while process_events():
-        # Tell Pygame we're on a new frame, with the given framerate
-        # set it to zero to unlimit.
-        FRAME_CLOCK.tick(FRAMERATE)
-        TIME += DELTA
-
-        # Let you do what you need to do.
-        try:
-            next(UPDATE_ITER)
-        except StopIteration:
+    global ACCUMULATOR
+    ACCUMULATOR = 0
+
+    if os.environ.get("RIBS_TRACE"):
+        start_trace(os.environ["RIBS_TRACE"])
+    if os.environ.get("RIBS_PROFILE"):
+        # Given as first:last, for example 100:400.
+        first, last = os.environ["RIBS_PROFILE"].split(":")
+        profile_frames(int(first), int(last),
+                       os.environ.get("RIBS_PROFILE_OUT", "ribs.prof"))
+
+    # Let you do what you need to do, and continue if we haven't quit.
+    while running:
+        _profile_frame(FRAME)
+        frame_start = perf_counter()
+        if not _run_frame():
             break
-
-        # Update the display
-        pg.display.flip()
-        clear_screen(pg.Color(0, 0, 0))
-
+        if not HEADLESS:
+            if PERF_OVERLAY:
+                with perf_scope("overlay"):
+                    _draw_perf_overlay()
+            if SPRITE_BATCH:
+                with perf_scope("batch"):
+                    draw_sprite_batch()
+            # Update the display
+            with perf_scope("flip"):
+                _present()
+            # With dirty rects the last frame is drawn over, not cleared.
+            if not DIRTY_RECTS:
+                with perf_scope("clear"):
+                    clear_screen(pg.Color(0, 0, 0))
+        # Waiting for the next frame isn't work, so it's not counted.
+        waited = _PHASES_THIS_FRAME.get("wait", 0.0)
+        frame_end = perf_counter()
+        _end_perf_frame(frame_end - frame_start - waited)
+        if TRACE_EVENTS is not None:
+            TRACE_EVENTS.append((f"frame {FRAME}", frame_start, frame_end - frame_start))
+
+    _finish_input()
+    stop_trace()
+    if PROFILER is not None:
+        # Quit before the last profiled frame, keep what we have.
+        _profile_frame(PROFILE_LAST)
+
+    _quit_sound()
     pg.mixer.quit()
     pg.display.quit()
     pg.quit()